@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Claude Code Vietnamese IME Fix - Keystroke Benchmark
+
+Runs every emitted fix variant in Node against a stand-in Cursor and replays
+Vietnamese IME streams (Telex, VNI, bursts split across events, large
+pastes). Reports p50/p99 latency, cursor allocations and renders per input
+event.
+
+Usage:
+  python3 bench.py                   Run all variants on all streams
+  python3 bench.py --rounds N        Replay each stream N times (default: 5)
+  python3 bench.py --json FILE       Also write the results as JSON
+"""
+
+import os
+import json
+import subprocess
+import sys
+import tempfile
+import unicodedata
+from pathlib import Path
+
+import patcher
+import patcher_bun
+
+GREEN = "\033[0;32m"
+BLUE = "\033[0;34m"
+NC = "\033[0m"
+
+DEL = "\x7f"
+
+# Sample prompt text, typed word by word
+SAMPLE_TEXT = (
+    "Hãy viết một hàm đọc tệp cấu hình và trả về danh sách người dùng. "
+    "Nếu tệp không tồn tại thì tạo mới với giá trị mặc định, "
+    "sau đó kiểm tra quyền truy cập trước khi ghi dữ liệu xuống ổ đĩa. "
+    "Giải thích ngắn gọn từng bước bằng tiếng Việt có dấu đầy đủ."
+)
+
+# Text already in the prompt when typing starts (long prompts are the slow case)
+PROMPT_PREFIX = "Ngữ cảnh: " + "dòng mã nguồn dài để mô phỏng prompt lớn; " * 250
+
+# Vowel marks and tones, as combining characters after NFD
+MARKS = {'\u0302': 'circumflex', '\u0306': 'breve', '\u031b': 'horn'}
+MARK_CHARS = {name: ch for ch, name in MARKS.items()}
+TONES = '\u0301\u0300\u0309\u0303\u0323'
+
+
+# ── IME stream simulation ─────────────────────────────────────────────────────
+
+def split_word(word):
+    """Split a word into (base letters, {pos: mark}, (tone pos, tone) or None)."""
+    bases, marks, tone = [], {}, None
+    for i, ch in enumerate(word):
+        if ch in 'đĐ':
+            bases.append('d' if ch == 'đ' else 'D')
+            marks[i] = 'đ'
+            continue
+        decomposed = unicodedata.normalize('NFD', ch)
+        bases.append(decomposed[0])
+        for combining in decomposed[1:]:
+            if combining in MARKS:
+                marks[i] = MARKS[combining]
+            elif combining in TONES:
+                tone = (i, combining)
+    return bases, marks, tone
+
+
+def render(bases, typed, marks, tone):
+    """Text shown for the first `typed` letters with the given marks/tone."""
+    out = []
+    for i in range(typed):
+        ch = bases[i]
+        if marks.get(i) == 'đ':
+            ch = 'đ' if ch == 'd' else 'Đ'
+        elif i in marks:
+            ch += MARK_CHARS[marks[i]]
+        if tone and tone[0] == i:
+            ch += tone[1]
+        out.append(unicodedata.normalize('NFC', ch))
+    return ''.join(out)
+
+
+def ime_events(text, tone_at_end):
+    """Input events an IME sends while `text` is typed.
+
+    Letters arrive one per event. A mark or tone key replaces the tail that
+    is already shown: DEL per removed character, then the new text. Telex
+    typists mostly add the tone at the end of the word (tone_at_end), VNI
+    typists right after the vowel, which moves the burst to mid-word.
+    """
+    events = []
+    for n, word in enumerate(text.split(' ')):
+        if n:
+            events.append(' ')
+        bases, marks, tone = split_word(word)
+        shown_marks, shown_tone, shown = {}, None, ''
+
+        def replace_tail(new):
+            prefix = len(os.path.commonprefix([shown, new]))
+            events.append(DEL * (len(shown) - prefix) + new[prefix:])
+            return new
+
+        for i in range(len(bases)):
+            new = render(bases, i + 1, shown_marks, shown_tone)
+            events.append(new[len(shown):])
+            shown = new
+            if i in marks:
+                shown_marks[i] = marks[i]
+                shown = replace_tail(render(bases, i + 1, shown_marks, shown_tone))
+            if tone and tone[0] == i and not tone_at_end:
+                shown_tone = tone
+                shown = replace_tail(render(bases, i + 1, shown_marks, shown_tone))
+        if tone and tone_at_end:
+            shown = replace_tail(render(bases, len(bases), shown_marks, tone))
+    return [e for e in events if e]
+
+
+def build_streams():
+    """Named input event streams to replay."""
+    telex = ime_events(SAMPLE_TEXT, tone_at_end=True)
+    vni = ime_events(SAMPLE_TEXT, tone_at_end=False)
+    # Some IMEs send a burst's DELs and its new text as two events
+    split = []
+    for event in telex:
+        new = event.lstrip(DEL)
+        split += [event[:len(event) - len(new)], new] if new else [event]
+    split = [e for e in split if e]
+    # A large paste arrives as one event holding every burst back to back
+    paste = [''.join(telex) * 40]
+    return {'telex': telex, 'vni': vni, 'split': split, 'paste': paste}
+
+
+# ── Fix variants ──────────────────────────────────────────────────────────────
+
+def npm_variant(coalesce=None, instrument=False):
+    """Handler running patcher.generate_fix() output, then the normal insert.
+
+    Only what cli.js declares outside the replaced block is in scope: the
+    input, the current cursor and the two setters, which publish the new
+    cursor through view(). The state variable is the fix's own.
+
+    Events are replayed back to back, so a coalescing variant never renders
+    a held burst on its own: the next event always joins it.
+    """
+    fix = patcher.generate_fix({
+        'input': 'input', 'state': 'state', 'cur_state': 'cur',
+        'update_text': 'setText', 'update_offset': 'setOffset',
+    }, coalesce, instrument)
+    return (
+        '(cur,input)=>{let text=cur.text,next;const setText=t=>{text=t},setOffset=o=>{next=view(text,o)};'
+        f'next=(()=>{{{fix}return cur.insert(input)}})()??next;return next??cur}}'
+    )
+
+
+def bun_variant():
+    """Handler running the whole patched key-handler function t()."""
+    fix = patcher_bun.FIX_CODE_NEW.decode('utf-8')
+    return (
+        '(()=>{let p;const X=0,Q=()=>{},T=0,e=()=>{},s=()=>{},TH=()=>{},HH=()=>{},'
+        '_H=()=>{},Uq=()=>false,wH=()=>{},jH=()=>{},YH=()=>{},ot4=new Set(),lK9=()=>false;'
+        f'{fix}'
+        'const key={key:""};return(cur,input)=>{p=cur;return t(key,input)}})()'
+    )
+
+
+def bun_legacy_variant():
+    """Handler running the legacy (< 2.1.114) Bun fix, then the normal insert."""
+    fix = patcher_bun.generate_fix(patcher_bun.BUG_PATTERN).decode('utf-8')
+    return (
+        '(b,RT)=>{let next;const DT={},R=()=>{},w=o=>{},WyT=()=>{},QyT=()=>{};'
+        'const done=(()=>{' + fix.replace('w(s.offset)', 'w(s.offset),next=s') + ';return 1})();'
+        'return done?b.insert(RT):next??b}'
+    )
+
+
+# Per-character reference: one cursor per DEL and per inserted character
+PER_CHAR_VARIANT = (
+    '(cur,input)=>{let s=cur;for(const c of input)s=c==="\\x7f"?s.backspace():s.insert(c);return s}'
+)
+
+
+def variants():
+    return {
+        'npm generate_fix': npm_variant(),
+        'npm generate_fix (coalesce)': npm_variant(coalesce=0),
+        'npm generate_fix (instrument)': npm_variant(instrument=True),
+        'bun FIX_CODE_NEW': bun_variant(),
+        'bun FIX_CODE (legacy)': bun_legacy_variant(),
+        'per-char (reference)': PER_CHAR_VARIANT,
+    }
+
+
+# ── Node harness ──────────────────────────────────────────────────────────────
+
+HARNESS = r"""
+"use strict";  // cli.js is an ES module: the fixes run in strict mode
+let allocs = 0;
+class Cursor {
+  constructor(text, offset) { this.text = text; this.offset = offset; allocs++; }
+  backspace() {
+    if (this.offset === 0) return this;
+    const cp = this.text.codePointAt(this.offset - 2);
+    const width = cp > 0xffff ? 2 : 1;
+    return new Cursor(this.text.slice(0, this.offset - width) + this.text.slice(this.offset),
+                      this.offset - width);
+  }
+  insert(s) {
+    return new Cursor(this.text.slice(0, this.offset) + s + this.text.slice(this.offset),
+                      this.offset + s.length);
+  }
+  deleteTokenBefore() { return null; }
+  equals(o) { return this.text === o.text && this.offset === o.offset; }
+  isAtStart() { return this.offset === 0; }
+  left() { return new Cursor(this.text, Math.max(0, this.offset - 1)); }
+}
+// The cursor a setter publishes: the app's state, not one the fix built
+const view = (text, offset) => Object.assign(Object.create(Cursor.prototype), { text, offset });
+
+const { variants, streams, prefix, rounds } = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const results = [];
+for (const [name, source] of Object.entries(variants)) {
+  const handler = eval(source);
+  for (const [stream, events] of Object.entries(streams)) {
+    const times = [];
+    let cursors = 0, renders = 0, expected = null;
+    for (let round = -1; round < rounds; round++) {  // round -1 warms up
+      let cur = new Cursor(prefix, prefix.length);
+      allocs = 0;
+      for (const input of events) {
+        const start = process.hrtime.bigint();
+        const next = handler(cur, input);
+        const elapsed = process.hrtime.bigint() - start;
+        if (round >= 0) {
+          times.push(Number(elapsed));
+          if (next !== cur) renders++;  // a new cursor means the prompt redraws
+        }
+        cur = next;
+      }
+      if (round >= 0) cursors += allocs;
+      expected = cur.text;
+    }
+    times.sort((a, b) => a - b);
+    const pick = q => times[Math.min(times.length - 1, Math.floor(q * times.length))] / 1000;
+    results.push({
+      variant: name, stream, events: events.length,
+      p50_us: pick(0.5), p99_us: pick(0.99),
+      cursors_per_event: cursors / (rounds * events.length),
+      renders_per_event: renders / (rounds * events.length),
+      text_sha: require('crypto').createHash('sha256').update(expected).digest('hex').slice(0, 12),
+    });
+  }
+}
+process.stdout.write(JSON.stringify(results));
+"""
+
+
+def run_benchmark(rounds):
+    """Run every variant over every stream in one Node process."""
+    with tempfile.TemporaryDirectory() as tmp:
+        # The instrumented variant writes its stats here, not into the real cache
+        os.environ['CLAUDE_VN_FIX_CACHE_DIR'] = tmp
+        payload = json.dumps({
+            'variants': variants(), 'streams': build_streams(),
+            'prefix': PROMPT_PREFIX, 'rounds': rounds,
+        })
+        harness = Path(tmp) / 'harness.js'
+        harness.write_text(HARNESS, encoding='utf-8')
+        result = subprocess.run(
+            ["node", str(harness)], input=payload,
+            capture_output=True, text=True, timeout=600
+        )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return json.loads(result.stdout)
+
+
+def main():
+    args = sys.argv[1:]
+    rounds = int(args[args.index('--rounds') + 1]) if '--rounds' in args else 5
+
+    print()
+    print("=" * 60)
+    print("  Claude Code Vietnamese IME Fix - Keystroke Benchmark")
+    print("=" * 60)
+    print()
+
+    print(f"{BLUE}-> Running {len(variants())} variants, {rounds} rounds...{NC}")
+    results = run_benchmark(rounds)
+    print()
+
+    header = (f"  {'Variant':<31}{'Stream':<8}{'Events':>8}{'p50 µs':>10}{'p99 µs':>10}"
+              f"{'Cursors/ev':>12}{'Renders/ev':>12}")
+    print(header)
+    print("  " + "-" * (len(header) - 2))
+    for r in results:
+        print(f"  {r['variant']:<31}{r['stream']:<8}{r['events']:>8}"
+              f"{r['p50_us']:>10.2f}{r['p99_us']:>10.2f}{r['cursors_per_event']:>12.2f}"
+              f"{r['renders_per_event']:>12.2f}")
+    print()
+
+    # Every variant must leave the same text behind for a given stream
+    mismatched = sorted({
+        r['stream'] for r in results
+        if len({o['text_sha'] for o in results if o['stream'] == r['stream']}) > 1
+    })
+    if mismatched:
+        print(f"  Output differs between variants on: {', '.join(mismatched)}")
+    else:
+        print(f"  {GREEN}✓{NC} All variants produce the same text")
+    print()
+
+    if '--json' in args:
+        out = Path(args[args.index('--json') + 1])
+        out.write_text(json.dumps(results, indent=2), encoding='utf-8')
+        print(f"  Results: {out}")
+
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
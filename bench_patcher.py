@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Claude Code Vietnamese IME Fix - Patcher Throughput Benchmark
+
+Generates synthetic targets (minified-looking cli.js files and Bun-like
+ELF binaries with the bug pattern in their .bun section) and measures scan, backup, patch,
+verify and restore: wall time, bytes read/written and peak RSS per phase.
+Each phase runs in a fresh interpreter, so peak RSS is that phase's own.
+
+Usage:
+  python3 bench_patcher.py                     cli.js 10,100 MB; Bun 50,500 MB
+  python3 bench_patcher.py --quick             Smallest size of each only
+  python3 bench_patcher.py --cli-sizes 10,50   cli.js sizes in MB
+  python3 bench_patcher.py --bun-sizes 50,200  Bun binary sizes in MB
+  python3 bench_patcher.py --dir DIR           Generate targets in DIR
+  python3 bench_patcher.py --json FILE         Write the results as JSON
+  python3 bench_patcher.py --save-baseline FILE
+                                               Store the results as baseline
+  python3 bench_patcher.py --baseline FILE     Compare against a baseline
+    --threshold PCT                            Allowed regression (default: 25)
+"""
+
+import io
+import os
+import sys
+import json
+import random
+import shutil
+import struct
+import tempfile
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+
+GREEN = "\033[0;32m"
+RED = "\033[0;31m"
+BLUE = "\033[0;34m"
+NC = "\033[0m"
+
+MB = 1 << 20
+PHASES = ("scan", "backup", "patch", "verify", "restore")
+CLI_POSITIONS = (0.1, 0.9)
+BUN_VARIANTS = ("new", "legacy", "legacy-re")
+
+# Bytes a Bun scan may read beyond its bundle: file headers, buffered reads
+HEADER_READ_SLACK = 64 * 1024
+
+# Floors below which a slowdown is noise, not a regression
+NOISE_FLOOR = {"wall": 0.05, "rss": 5 * MB, "read": MB, "written": MB}
+
+
+# ── Synthetic targets ─────────────────────────────────────────────────────────
+
+DEL = b"\x7f"
+NPM_BUG_BLOCK = (
+    b'function h(A,K,J,M,O,L,N){if(!K.backspace&&!K.delete&&A.includes("' + DEL + b'")){'
+    b'let B=(A.match(/\\x7f/g)||[]).length,Q=J;'
+    b'for(let W=0;W<B;W++)Q=Q.deleteTokenBefore()??Q.backspace();'
+    b'if(!J.equals(Q)){if(J.text!==Q.text)M(Q.text);O(Q.offset)}L(),N();return}return 1}\n'
+)
+
+
+def js_filler(seed, size=MB):
+    """About `size` bytes of minified-looking JavaScript."""
+    rng = random.Random(seed)
+    names = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ$_") for _ in range(rng.randint(1, 3)))
+             for _ in range(500)]
+    parts, total = [], 0
+    while total < size:
+        a, b, c = rng.sample(names, 3)
+        part = rng.choice((
+            f'function {a}({b},{c}){{if(!{b})return {c};return {b}.map(({c})=>{c}+1)}}',
+            f'var {a}={{{b}:"{c}",{c}:[{rng.randint(0, 9999)},{b}]}};',
+            f'class {a} extends {b}{{constructor({c}){{super({c});this.{c}=new Map}}}}',
+            f'const {a}=`{b}${{{c}}}`,{b}=/[{c}]+/g;',
+        ))
+        parts.append(part)
+        total += len(part)
+    return "".join(parts).encode("utf-8")
+
+
+def write_filler(f, filler, size):
+    while size > 0:
+        f.write(filler[:size])
+        size -= min(size, len(filler))
+
+
+def generate_cli_js(path, size, position):
+    """cli.js of `size` bytes with the bug block at `position` (0..1)."""
+    import patcher
+
+    filler = js_filler(seed=size)
+    version_line = b'\nif(process.argv.includes("--version"))console.log("0.0.0 (Claude Code)");\n'
+    body = size - len(NPM_BUG_BLOCK) - len(version_line)
+    with open(path, "wb") as f:
+        f.write(b"#!/usr/bin/env node\n")
+        write_filler(f, filler, int(body * position))
+        f.write(b"\n" + NPM_BUG_BLOCK)
+        write_filler(f, filler, body - int(body * position))
+        f.write(version_line)
+    assert patcher.BUG_PATTERN in NPM_BUG_BLOCK
+
+
+def bun_pattern(variant):
+    import patcher_bun
+
+    if variant == "new":
+        return patcher_bun.BUG_PATTERN_NEW
+    if variant == "legacy":
+        return patcher_bun.BUG_PATTERN
+    # Same shape, other minified names: only the regex matches it
+    return patcher_bun.BUG_PATTERN.replace(b"DT", b"Qa").replace(b"R(IT", b"Zz(IT")
+
+
+def elf_header(shoff, shnum, shstrndx):
+    """64-bit little-endian ELF header of an x86-64 executable, no program headers."""
+    ident = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+    return ident + struct.pack("<HHIQQQIHHHHHH", 2, 0x3E, 1, 0, 0, shoff, 0, 64, 56, 0, 64, shnum, shstrndx)
+
+
+def elf_section(name, sh_type, offset, size):
+    """One 64-bit ELF section header."""
+    return struct.pack("<IIQQQQIIQQ", name, sh_type, 0, 0, offset, size, 0, 0, 1, 0)
+
+
+def generate_bun(path, size, variant):
+    """Bun-like ELF: machine code, then a .bun section holding the JS bundle.
+
+    The bundle ends with the Bun trailer, and a section header table names
+    it, as in real Linux builds. Returns the bundle's (start, end).
+    """
+    import patcher_bun
+
+    shstrtab = b"\0" + patcher_bun.BUN_SECTION + b"\0.shstrtab\0"
+    tables = len(shstrtab) + 3 * 64
+    bundle_size = max(size // 5, MB)
+    bundle_start = size - tables - bundle_size
+    native = os.urandom(MB)
+    filler = js_filler(seed=size)
+    pattern = bun_pattern(variant)
+    with open(path, "wb") as f:
+        f.write(elf_header(shoff=size - 3 * 64, shnum=3, shstrndx=2))
+        write_filler(f, native, bundle_start - 64)
+        half = (bundle_size - len(pattern) - len(patcher_bun.BUN_TRAILER) - 8) // 2
+        write_filler(f, filler, half)
+        f.write(pattern)
+        write_filler(f, filler, bundle_size - len(pattern) - len(patcher_bun.BUN_TRAILER) - 8 - half)
+        f.write(patcher_bun.BUN_TRAILER)
+        f.write(struct.pack("<Q", bundle_size))
+        f.write(shstrtab)
+        f.write(elf_section(0, 0, 0, 0))
+        f.write(elf_section(1, 1, bundle_start, bundle_size))  # .bun, PROGBITS
+        f.write(elf_section(1 + len(patcher_bun.BUN_SECTION) + 1, 3, bundle_start + bundle_size, len(shstrtab)))
+    os.chmod(path, 0o755)
+    return bundle_start, bundle_start + bundle_size
+
+
+# ── Phase runner (child process) ──────────────────────────────────────────────
+
+def proc_io():
+    """(bytes read, bytes written) by this process so far, or (None, None)."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            stats = dict(line.split(": ") for line in f.read().splitlines())
+        return int(stats["rchar"]), int(stats["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss():
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_phase(kind, phase, path):
+    """Run one phase on path in this process and return its metrics."""
+    import time
+    import patcher
+    import patcher_bun
+    from patcher_common import start_backup, store_backup, tee_scan
+
+    module = patcher if kind == "npm" else patcher_bun
+    scan = patcher.iter_bug_blocks if kind == "npm" else patcher_bun.iter_bug_patterns
+    output = io.StringIO()
+    read0, written0 = proc_io()
+    started = time.perf_counter()
+    with redirect_stdout(output), redirect_stderr(output):
+        if phase == "scan":
+            ok = sum(1 for _ in scan(path)) > 0
+        elif phase == "backup":
+            # One read hashes the file and feeds the copy, as patch() does
+            staged = start_backup(path)
+            _, sha256 = tee_scan(path, staged=staged)
+            store_backup(path, sha256, staged=staged)
+            ok = True
+        elif phase == "patch":
+            ok = module.patch(path, use_cache=False) == 0
+        elif phase == "verify":
+            # Full rescan: no bug pattern may be left
+            ok = next(scan(path), None) is None
+        else:
+            ok = module.restore(path) == 0
+    wall = time.perf_counter() - started
+    read1, written1 = proc_io()
+    return {
+        "ok": ok,
+        "wall": wall,
+        "read": None if read0 is None else read1 - read0,
+        "written": None if written0 is None else written1 - written0,
+        "rss": peak_rss(),
+        "output": output.getvalue()[-500:] if not ok else "",
+    }
+
+
+def measure(kind, phase, path, env):
+    """Run a phase in a fresh interpreter and return its metrics."""
+    result = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), "--phase", kind, phase, str(path)],
+        capture_output=True, text=True, env=env, cwd=SCRIPT_DIR,
+    )
+    if result.returncode != 0:
+        return {"ok": False, "wall": 0.0, "read": None, "written": None, "rss": None,
+                "output": result.stderr[-500:]}
+    return json.loads(result.stdout)
+
+
+# ── Benchmark ─────────────────────────────────────────────────────────────────
+
+def build_cases(args):
+    def sizes(name, default):
+        value = args[args.index(name) + 1] if name in args else default
+        return [int(s) for s in value.split(",")]
+
+    cli_sizes = sizes("--cli-sizes", "10,100")
+    bun_sizes = sizes("--bun-sizes", "50,500")
+    if "--quick" in args:
+        cli_sizes, bun_sizes = cli_sizes[:1], bun_sizes[:1]
+
+    cases = [("npm", size, f"at-{int(pos * 100)}%") for size in cli_sizes for pos in CLI_POSITIONS]
+    cases += [("bun", size, variant) for size in bun_sizes for variant in BUN_VARIANTS]
+    return cases
+
+
+def run_case(kind, size_mb, variant, work_dir, env):
+    """Generate one target, run every phase on it, return {phase: metrics}."""
+    from patcher_common import file_sha256
+
+    path = work_dir / ("cli.js" if kind == "npm" else "claude")
+    bundle = None
+    if kind == "npm":
+        generate_cli_js(path, size_mb * MB, int(variant[3:-1]) / 100)
+    else:
+        bundle = generate_bun(path, size_mb * MB, variant)
+    original = file_sha256(path)
+
+    metrics = {phase: measure(kind, phase, path, env) for phase in PHASES}
+    if file_sha256(path) != original:
+        metrics["restore"].update(ok=False, output="restored file differs from the original")
+
+    # A Bun scan reads the .bun section only, not the whole binary
+    read = metrics["scan"]["read"]
+    if bundle and read is not None and not 0 <= read - (bundle[1] - bundle[0]) <= HEADER_READ_SLACK:
+        metrics["scan"].update(ok=False, output=f"scan read {read} bytes for a {bundle[1] - bundle[0]}-byte bundle")
+
+    shutil.rmtree(work_dir)
+    work_dir.mkdir()
+    return metrics
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regression messages against baseline."""
+    regressions = []
+    for key, phases in results.items():
+        for phase, m in phases.items():
+            base = baseline.get(key, {}).get(phase)
+            if not base:
+                continue
+            for metric, floor in NOISE_FLOOR.items():
+                new, old = m.get(metric), base.get(metric)
+                if new is None or old is None:
+                    continue
+                if new > old * (1 + threshold / 100) and new - old > floor:
+                    regressions.append(f"{key} {phase} {metric}: {old:.4g} -> {new:.4g}")
+    return regressions
+
+
+def fmt_mb(value):
+    return "-" if value is None else f"{value / MB:.1f}"
+
+
+def main():
+    args = sys.argv[1:]
+
+    if "--phase" in args:
+        idx = args.index("--phase")
+        kind, phase, path = args[idx + 1:idx + 4]
+        print(json.dumps(run_phase(kind, phase, path)))
+        return 0
+
+    print()
+    print("=" * 60)
+    print("  Claude Code Vietnamese IME Fix - Patcher Benchmark")
+    print("=" * 60)
+    print()
+
+    root = Path(args[args.index("--dir") + 1]) if "--dir" in args else None
+    root = Path(tempfile.mkdtemp(prefix="vnfix-bench-", dir=root))
+    work_dir = root / "target"
+    work_dir.mkdir()
+    # Keep the user's offset cache out of it
+    env = dict(os.environ, CLAUDE_VN_FIX_CACHE_DIR=str(root / "cache"))
+
+    results = {}
+    try:
+        for kind, size_mb, variant in build_cases(args):
+            key = f"{kind}-{size_mb}MB-{variant}"
+            print(f"{BLUE}-> {key}{NC}")
+            results[key] = run_case(kind, size_mb, variant, work_dir, env)
+            for phase, m in results[key].items():
+                mark = f"{GREEN}✓{NC}" if m["ok"] else f"{RED}✗{NC}"
+                print(f"   {mark} {phase:<8}{m['wall']:>8.3f}s  read {fmt_mb(m['read']):>7} MB"
+                      f"  written {fmt_mb(m['written']):>7} MB  peak RSS {fmt_mb(m['rss']):>6} MB")
+                if not m["ok"]:
+                    print(f"     {m['output'].strip()}")
+            print()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    failed = [key for key, phases in results.items() if not all(m["ok"] for m in phases.values())]
+
+    if "--json" in args:
+        Path(args[args.index("--json") + 1]).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if "--save-baseline" in args:
+        out = Path(args[args.index("--save-baseline") + 1])
+        out.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"   Baseline: {out}")
+
+    regressions = []
+    if "--baseline" in args:
+        threshold = float(args[args.index("--threshold") + 1]) if "--threshold" in args else 25
+        baseline = json.loads(Path(args[args.index("--baseline") + 1]).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, threshold)
+        for message in regressions:
+            print(f"   {RED}✗{NC} regression: {message}")
+        if not regressions:
+            print(f"   {GREEN}✓{NC} no regression over {threshold:g}% against baseline")
+
+    print("=" * 60)
+    if failed:
+        print(f"{RED}Failed: {', '.join(failed)}{NC}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env bash
+#
+# Claude Code Vietnamese IME Fix - Launcher
+# Chạy claude; nếu Claude Code vừa tự cập nhật (file khác với lúc patch)
+# thì patch lại trước. Chỉ tốn một lần stat, không đọc lại binary/cli.js.
+#
+# Usage:
+#   alias claude="$HOME/.claude-vn-fix/claude-vn.sh"
+#
+# CLAUDE_VN_FIX_CLAUDE chọn claude cụ thể (mặc định: claude trong PATH).
+# Nếu patch thất bại (ví dụ bản Claude Code mới không còn bug pattern), bản
+# build đó được ghi nhớ và không patch lại cho tới khi file thay đổi tiếp.
+#
+
+set -uo pipefail
+
+FIX_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+CLAUDE_BIN="${CLAUDE_VN_FIX_CLAUDE:-$(command -v claude)}"
+
+if [ -z "$CLAUDE_BIN" ]; then
+    echo "[claude-vn] Không tìm thấy claude trong PATH" >&2
+    exit 127
+fi
+
+# The file that actually gets patched: cli.js for npm, the binary for Bun
+TARGET="$(realpath "$CLAUDE_BIN" 2>/dev/null || echo "$CLAUDE_BIN")"
+
+# size, whole-second mtime and inode, as in the .vnfix-state record
+if stat -L -c '%s %Y %i' "$TARGET" >/dev/null 2>&1; then
+    CURRENT="$(stat -L -c '%s %Y %i' "$TARGET")"
+else
+    CURRENT="$(stat -L -f '%z %m %i' "$TARGET" 2>/dev/null)"
+fi
+
+# Builds the patcher already failed on, one "size mtime inode target" per line
+CACHE_DIR="${CLAUDE_VN_FIX_CACHE_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/claude-vn-fix}"
+FAILED_FILE="$CACHE_DIR/launcher-failed"
+
+# Drop the line for $TARGET from FAILED_FILE
+forget_failure() {
+    [ -f "$FAILED_FILE" ] || return 0
+    awk -v t="$TARGET" '{ line = $0; sub(/^[^ ]+ [^ ]+ [^ ]+ /, "", line) } line != t' \
+        "$FAILED_FILE" > "$FAILED_FILE.$$" && mv "$FAILED_FILE.$$" "$FAILED_FILE"
+}
+
+RECORDED=""
+if [ -f "$TARGET.vnfix-state" ] && read -r magic _ size _ mtime ino _ < "$TARGET.vnfix-state" \
+    && [ "$magic" = "vnfix-state" ]; then
+    RECORDED="$size $mtime $ino"
+fi
+
+if [ -n "$CURRENT" ] && [ "$CURRENT" != "$RECORDED" ] \
+    && grep -qxF "$CURRENT $TARGET" "$FAILED_FILE" 2>/dev/null; then
+    :  # Failed on this exact build before: wait for the next update
+elif [ -z "$CURRENT" ] || [ "$CURRENT" != "$RECORDED" ]; then
+    PYTHON_CMD="$(command -v python3 || command -v python)"
+    case "$TARGET" in
+        *.js) PATCHER="patcher.py" ;;
+        *)    PATCHER="patcher_bun.py" ;;
+    esac
+    echo "[claude-vn] Claude Code đã thay đổi, đang patch lại..." >&2
+    if "$PYTHON_CMD" "$FIX_DIR/$PATCHER" --path "$TARGET" >&2; then
+        forget_failure
+    else
+        echo "[claude-vn] Patch thất bại, vẫn chạy claude (không thử lại cho tới bản cập nhật sau)" >&2
+        forget_failure
+        [ -n "$CURRENT" ] && mkdir -p "$CACHE_DIR" 2>/dev/null \
+            && echo "$CURRENT $TARGET" >> "$FAILED_FILE"
+    fi
+fi
+
+exec "$CLAUDE_BIN" "$@"
@@ -7,8 +7,26 @@ the backspace handling logic to also insert replacement text.
 
 Usage:
   python3 patcher.py              Auto-detect and fix
-  python3 patcher.py --restore    Restore from backup
+  python3 patcher.py --restore    Restore from journal/backup
+  python3 patcher.py --restore --verify
+                                  Also check the full-file checksum
   python3 patcher.py --path FILE  Fix specific file
+  python3 patcher.py --no-cache   Always search, ignore cached offsets
+  python3 patcher.py --timings    Print a per-phase timing table
+  python3 patcher.py --json       Per-phase metrics as JSON on stdout
+  python3 patcher.py --status     patched/unpatched/changed, one stat, no scan
+  python3 patcher.py --list       List every npm installation found
+  python3 patcher.py --all        Fix every npm install and Bun binary, in parallel
+  python3 patcher.py --watch      Stay running, re-patch after auto-updates
+  python3 patcher.py --no-wait    Skip the target if another run is patching it
+  python3 patcher.py --coalesce MS
+                                  Also join IME bursts split across events
+  python3 patcher.py --instrument Count and time IME events in the patched handler
+  python3 patcher.py --report     Summarise the stats instrumented runs wrote
+  python3 patcher.py --export FILE
+                                  Save the patch as a portable artifact
+  python3 patcher.py --apply FILE
+                                  Apply an artifact to an identical build, no scan
 
 Repository: https://github.com/manhit96/claude-code-vietnamese-fix
 License: MIT
@@ -17,38 +35,145 @@ License: MIT
 import os
 import re
 import sys
-import shutil
+import json
+import hashlib
 import platform
 import subprocess
 from pathlib import Path
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from patcher_common import (
+    CHUNK_SIZE, stream_find, needle_scan, tee_scan, read_range, rewrite_file, shift_offsets,
+    file_fingerprint, cache_lookup, cache_store, cache_forget,
+    load_cache_file, save_cache_file,
+    write_journal, load_journal, restore_journal,
+    discard_journal, journal_path,
+    PATCH_RULES, add_rule, rules_for,
+    write_artifact, load_artifact, check_artifact, artifact_applied,
+    BACKUP_KEEP, start_backup, discard_backup, store_backup, latest_backup, replace_from, prune_backups,
+    run_fleet, phase, run_measured,
+    write_state, clear_state, show_status, patch_status, STATE_PATCHED, watch,
+    locked, atomic_update, STATS_FILE, STATS_BUCKETS, report_stats,
+)
 
 PATCH_MARKER = "/* Vietnamese IME fix */"
 DEL_CHAR = chr(127)  # 0x7F - character used by Vietnamese IME for backspace
 
+BUG_PATTERN = f'.includes("{DEL_CHAR}")'.encode('utf-8')
 
-def find_cli_js():
-    """Auto-detect Claude Code npm cli.js location."""
+# Install discovery
+SEARCH_MAX_DEPTH = 4  # e.g. ~/.nvm/versions/node -> v20/lib/node_modules
+SEARCH_SKIP = {'.git', '.cache', '_cacache', '_logs', 'bin', 'include', 'share', 'etc'}
+INSTALL_INDEX_FORMAT = 1
+
+BUG_NOT_FOUND = (
+    'Không tìm thấy bug pattern .includes("\\x7f").\n'
+    "Claude Code có thể đã được Anthropic fix."
+)
+
+
+def search_roots():
+    """Directories where npm, npx and nvm put Claude Code installs."""
     home = Path.home()
     is_windows = platform.system() == 'Windows'
 
     if is_windows:
-        search_dirs = [
+        return [
             Path(os.environ.get('LOCALAPPDATA', '')) / 'npm-cache' / '_npx',
             Path(os.environ.get('APPDATA', '')) / 'npm' / 'node_modules',
         ]
-    else:
-        search_dirs = [
-            home / '.npm' / '_npx',
-            home / '.nvm' / 'versions' / 'node',
-            Path('/usr/local/lib/node_modules'),
-            Path('/opt/homebrew/lib/node_modules'),
-        ]
+    return [
+        home / '.npm' / '_npx',
+        home / '.nvm' / 'versions' / 'node',
+        Path('/usr/local/lib/node_modules'),
+        Path('/opt/homebrew/lib/node_modules'),
+    ]
+
+
+def _walk_root(root):
+    """Find cli.js installs under root.
+
+    Only node_modules/@anthropic-ai/claude-code is looked at inside a
+    node_modules directory; other packages, SEARCH_SKIP entries and
+    anything deeper than SEARCH_MAX_DEPTH are never listed.
+    Returns (found, mtimes) where mtimes holds the mtime of every directory
+    the result depends on, for invalidating the install index.
+    """
+    found, mtimes = [], {}
+    stack = [(str(root), 0)]
+    while stack:
+        dir_path, depth = stack.pop()
+        try:
+            mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+            if os.path.basename(dir_path) == 'node_modules':
+                scope = os.path.join(dir_path, '@anthropic-ai')
+                mtimes[scope] = os.stat(scope).st_mtime_ns
+                cli_js = os.path.join(scope, 'claude-code', 'cli.js')
+                if os.path.isfile(cli_js):
+                    found.append(cli_js)
+                continue
+
+            if depth >= SEARCH_MAX_DEPTH:
+                continue
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name not in SEARCH_SKIP and entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, depth + 1))
+        except OSError:
+            continue
+    return found, mtimes
+
+
+def _index_valid(entry):
+    """True if no directory recorded in an index entry has changed."""
+    try:
+        return (
+            all(os.stat(d).st_mtime_ns == m for d, m in entry['mtimes'].items())
+            and all(os.path.isfile(f) for f in entry['found'])
+        )
+    except OSError:
+        return False
+
+
+def _install_sort_key(cli_js):
+    """Sort key putting the newest version (then newest file) first."""
+    version = detect_version(cli_js) or ''
+    parts = tuple(int(p) if p.isdigit() else 0 for p in re.split(r'[.-]', version)[:3])
+    try:
+        mtime = os.path.getmtime(cli_js)
+    except OSError:
+        mtime = 0
+    return parts, mtime
+
+
+def find_all_cli_js(use_index=True):
+    """Find every Claude Code npm cli.js, newest version first.
+
+    Roots are walked in parallel. Results are kept in an index in the cache
+    directory and reused as long as none of the directories they depend on
+    has a new mtime, so repeat runs only stat a handful of directories.
+    """
+    roots = [str(r) for r in search_roots() if r.exists()]
+    index = load_cache_file('installs.json', INSTALL_INDEX_FORMAT) if use_index else None
+    entries = index['roots'] if index else {}
 
-    for d in search_dirs:
-        if d.exists():
-            for cli_js in d.rglob('*/@anthropic-ai/claude-code/cli.js'):
-                return str(cli_js)
+    stale = [r for r in roots if r not in entries or not _index_valid(entries[r])]
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+            for root, (found, mtimes) in zip(stale, pool.map(_walk_root, stale)):
+                entries[root] = {'found': found, 'mtimes': mtimes}
+        if use_index:
+            save_cache_file('installs.json', {'format': INSTALL_INDEX_FORMAT, 'roots': entries})
+
+    installs = {f for r in roots for f in entries[r]['found']}
+    return sorted(installs, key=_install_sort_key, reverse=True)
+
+
+def find_cli_js():
+    """Auto-detect Claude Code npm cli.js location (newest install)."""
+    installs = find_all_cli_js()
+    if installs:
+        return installs[0]
 
     raise FileNotFoundError(
         "Không tìm thấy Claude Code npm.\n"
@@ -56,65 +181,276 @@ def find_cli_js():
     )
 
 
-def find_bug_block(content):
-    """Find the if-block containing the Vietnamese IME bug pattern."""
-    pattern = f'.includes("{DEL_CHAR}")'
-    idx = content.find(pattern)
+# ── JavaScript lexer ──────────────────────────────────────────────────────────
+# One linear pass over cli.js that knows which bytes are code: strings,
+# template literals, regex literals and comments are consumed whole, so
+# braces inside them never count. Brackets are only tracked inside if(...)
+# conditions, the bodies of if-blocks that check for DEL and template ${...}
+# expressions; everywhere else the lexer jumps from one quote, slash or if(
+# to the next.
+JS_IDLE_RE = re.compile(rb'["\'`/]')
+JS_TRACK_RE = re.compile(rb'["\'`/(){}]')
+JS_IF_RE = re.compile(rb'if\s*\(')  # searched apart: far faster than one alternation
+JS_STRING_RE = re.compile(rb'"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"|\'[^\'\\\n]*(?:\\[\s\S][^\'\\\n]*)*\'')
+JS_TEMPLATE_RE = re.compile(rb'(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(`|\$\{)')
+JS_LINE_COMMENT_RE = re.compile(rb'//[^\n]*')
+JS_BLOCK_COMMENT_RE = re.compile(rb'/\*[\s\S]*?\*/')
+JS_REGEX_RE = re.compile(rb'/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*')
+JS_WORD_RE = re.compile(rb'[\w$]+$')
+JS_WORD_BYTES = frozenset(b'_$0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.')
+
+# A / after one of these starts a regex literal; after any other word, a
+# closing bracket or a literal it divides
+JS_KEYWORDS_BEFORE_EXPR = {
+    b'return', b'typeof', b'instanceof', b'in', b'of', b'new', b'delete',
+    b'void', b'throw', b'case', b'do', b'else', b'yield', b'await',
+}
+
+# The DEL check: INPUT.includes("\x7f"), with the character raw or escaped
+DEL_CALL = b'.includes('
+DEL_STRINGS = {
+    q + body + q
+    for q in (b'"', b"'")
+    for body in (DEL_CHAR.encode('utf-8'), b'\\x7f', b'\\x7F', b'\\u007f', b'\\u007F')
+}
+
+# Token bytes, as the ints indexing bytes yields
+QUOTES, OPENERS = b'"\'', b'({'
+BACKTICK, SLASH, CLOSE_PAREN = b'`/)'
+
+JS_LOOKBACK = 64                # bytes kept before the read position for look-behind
+JS_MAX_REGEX = 64 * 1024        # no regex literal is longer; a / without one divides
+JS_MAX_TOKEN = 16 * CHUNK_SIZE  # longest string, template or comment looked for
+
+
+def _regex_allowed(buf, i):
+    """Whether a / at buf[i] starts a regex literal rather than a division."""
+    j = i - 1
+    while j >= 0 and buf[j] in b' \t\r\n':
+        j -= 1
+    if j < 0:
+        return True
+    if buf[j] in b')]"\'`':
+        return False
+    word = JS_WORD_RE.search(buf, max(0, j - 11), j + 1)
+    if word:
+        return word.group() in JS_KEYWORDS_BEFORE_EXPR
+    return True
+
+
+def lex_bug_blocks(read, chunk_size=CHUNK_SIZE):
+    """Yield (block_start, block_end, block) for every if-block checking for DEL.
+
+    read(n) returns the next bytes of cli.js, b'' at the end. The block runs
+    from its if( to the brace closing its body, with exact offsets, however
+    long the condition or body is and whatever they contain. Only the bytes
+    of an open block are held on top of one chunk.
+    """
+    buf, base, pos, eof = b'', 0, 0, False
+    # Open brackets: [kind, absolute start, condition checks DEL]; kind is
+    # 'if' for a condition, 'body' for the body of a DEL-checking if-block
+    stack = []
+
+    def more():
+        nonlocal buf, base, pos, eof
+        chunk = read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        keep = min([pos - JS_LOOKBACK] + [f[1] - base for f in stack if f[0] in ('if', 'body')])
+        keep = max(0, keep)
+        buf, base, pos = buf[keep:] + chunk, base + keep, pos - keep
+        return True
+
+    def read_on(i, limit=JS_MAX_TOKEN):
+        # The token at buf[i] ran into the end of buf: retry it with more
+        # bytes, unless it is too long to be a token at all
+        nonlocal pos
+        if eof or len(buf) - i >= limit:
+            return False
+        pos = i
+        return more()
+
+    def template():
+        # Template text from pos: ends the literal, or opens a ${ expression
+        nonlocal pos
+        match = JS_TEMPLATE_RE.match(buf, pos)
+        while match is None and read_on(pos):
+            match = JS_TEMPLATE_RE.match(buf, pos)
+        if match is None:
+            pos = len(buf)
+        else:
+            if match.group(1) == b'${':
+                stack.append(['${', base + match.start(), False])
+            pos = match.end()
+
+    def next_if():
+        # Absolute offset of the next if( keyword from pos, or None if buf
+        # holds none; a few bytes are left for one straddling the border
+        found = JS_IF_RE.search(buf, pos)
+        while found and found.start() and buf[found.start() - 1] in JS_WORD_BYTES:
+            found = JS_IF_RE.search(buf, found.start() + 2)
+        return base + found.start() if found else None
+
+    more()
+    if_at, if_searched = next_if(), base + len(buf) - 16
+    while True:
+        if if_at is None and if_searched < base + len(buf) - 16 or \
+                if_at is not None and if_at < base + pos:
+            if_at, if_searched = next_if(), base + len(buf) - 16
+
+        limit = len(buf) if if_at is None else if_at - base
+        token = (JS_TRACK_RE if stack else JS_IDLE_RE).search(buf, pos, limit)
+        if token is None:
+            if if_at is not None:
+                stack.append(['if', if_at, False])
+                pos = JS_IF_RE.match(buf, if_at - base).end()
+                continue
+            pos = max(pos, len(buf) - 16)
+            if not more():
+                return
+            continue
+
+        i = token.start()
+        c = buf[i]
+        if c in QUOTES:
+            # No end before the end of buf: read on; strings end on their line
+            match = JS_STRING_RE.match(buf, i)
+            if match is None and buf.find(b'\n', i) == -1 and read_on(i):
+                continue
+            pos = match.end() if match else i + 1
+            if match and match.group() in DEL_STRINGS and buf[i - len(DEL_CALL):i] == DEL_CALL:
+                for frame in reversed(stack):
+                    if frame[0] == 'if':
+                        frame[2] = True
+                        break
+
+        elif c == BACKTICK:
+            pos = i + 1
+            template()
+
+        elif c == SLASH:
+            nxt = buf[i + 1:i + 2]
+            if nxt in (b'/', b'*'):
+                comment = (JS_LINE_COMMENT_RE if nxt == b'/' else JS_BLOCK_COMMENT_RE).match(buf, i)
+                if (comment is None or comment.end() == len(buf)) and read_on(i):
+                    continue
+                pos = comment.end() if comment else len(buf)
+            elif _regex_allowed(buf, i):
+                literal = JS_REGEX_RE.match(buf, i)
+                if (literal is None or literal.end() == len(buf)) and read_on(i, JS_MAX_REGEX):
+                    continue
+                pos = literal.end() if literal else i + 1
+            else:
+                pos = i + 1
+
+        elif c in OPENERS:
+            stack.append([chr(c), base + i, False])
+            pos = i + 1
+
+        elif c == CLOSE_PAREN:
+            # The { of a body has to be in buf before the condition is popped
+            brace = i + 1
+            while brace < len(buf) and buf[brace] in b' \t\r\n':
+                brace += 1
+            if brace == len(buf) and read_on(i):
+                continue
+            pos = i + 1
+            while stack:
+                kind, start, checks_del = stack.pop()
+                if kind == 'if' and checks_del and buf[brace:brace + 1] == b'{':
+                    stack.append(['body', start, False])
+                    pos = brace + 1
+                if kind in ('(', 'if'):
+                    break
+
+        else:  # }
+            pos = i + 1
+            while stack:
+                kind, start, _ = stack.pop()
+                if kind == '${':
+                    template()
+                elif kind == 'body':
+                    yield start, base + i + 1, buf[start - base:i + 1]
+                if kind in ('{', '${', 'body'):
+                    break
+
+
+def iter_bug_blocks(file_path, chunk_size=CHUNK_SIZE, rules=None):
+    """Stream file_path and yield (block_start, block_end, block).
+
+    Reads fixed-size chunks instead of the whole file, so memory use stays
+    at a few MB however large cli.js grows. patch() gets the same blocks
+    from its single read instead (see read_patch_state).
+    """
+    # No anchor anywhere, nothing to lex: one fast search saves the pass
+    rules = rules or PATCH_RULES['npm']
+    if all(next(stream_find(file_path, rule['anchor'], chunk_size), None) is None
+                         for rule in rules):
+        return
+
+    with open(file_path, 'rb') as f:
+        yield from _match_rules(lex_bug_blocks(f.read, chunk_size), rules)
+
+
+def read_patch_state(file_path, rules=None, staged=None, locate=False):
+    """Look for PATCH_MARKER while hashing cli.js.
+
+    One read (tee_scan()) also copies the staged backup and, with locate,
+    feeds the same blocks to the lexer to find every bug block. Returns
+    (patched, located, sha256); located is None without locate.
+    """
+    marker = PATCH_MARKER.encode('utf-8')
+    located = [] if locate else None
+
+    def lex(read):
+        located.extend(_match_rules(lex_bug_blocks(read), rules))
+
+    hits, sha256 = tee_scan(
+        file_path, needle_scan([marker]), len(marker), staged=staged, consume=lex if locate else None,
+    )
+    return bool(hits), located, sha256
 
-    if idx == -1:
-        raise RuntimeError(
-            'Không tìm thấy bug pattern .includes("\\x7f").\n'
-            "Claude Code có thể đã được Anthropic fix."
-        )
 
-    # Find the containing if(
-    block_start = content.rfind('if(', max(0, idx - 150), idx)
-    if block_start == -1:
-        raise RuntimeError("Không tìm thấy block if chứa pattern")
-
-    # Find matching closing brace
-    depth = 0
-    block_end = idx
-    for i, c in enumerate(content[block_start:block_start + 800]):
-        if c == '{':
-            depth += 1
-        elif c == '}':
-            depth -= 1
-            if depth == 0:
-                block_end = block_start + i + 1
+def _match_rules(blocks, rules):
+    rules = rules or PATCH_RULES['npm']
+    for block_start, block_end, block in blocks:
+        for rule in rules:
+            hit = block.find(rule['anchor'])
+            if hit != -1 and rule['match'](block, hit, 0, len(block)):
+                yield block_start, block_end, block
                 break
 
-    if depth != 0:
-        raise RuntimeError("Không tìm thấy closing brace của block if")
 
-    return block_start, block_end, content[block_start:block_end]
+# Variable names of the bug block, compiled once; DEL is normalized to \x7f
+# Match: let COUNT=(INPUT.match(/\x7f/g)||[]).length,STATE=CURSTATE;
+COUNT_STATE_RE = re.compile(
+    r'let ([\w$]+)=\(\w+\.match\(/\\x7f/g\)\|\|\[\]\)\.length[,;]([\w$]+)=([\w$]+)[;,]'
+)
+# Match: UPDATETEXT(STATE.text);UPDATEOFFSET(STATE.offset)
+UPDATE_RE = re.compile(r'([\w$]+)\(([\w$]+)\.text\);([\w$]+)\(\2\.offset\)')
+# Match: INPUT.includes("
+INPUT_RE = re.compile(r'([\w$]+)\.includes\("')
 
 
 def extract_variables(block):
-    """Extract dynamic variable names from the bug block."""
+    """Extract dynamic variable names from the bug block (bytes)."""
+    block = block.decode('utf-8')
+
     # Normalize DEL char for regex matching
     normalized = block.replace(DEL_CHAR, '\\x7f')
 
-    # Match: let COUNT=(INPUT.match(/\x7f/g)||[]).length,STATE=CURSTATE;
-    m = re.search(
-        r'let ([\w$]+)=\(\w+\.match\(/\\x7f/g\)\|\|\[\]\)\.length[,;]([\w$]+)=([\w$]+)[;,]',
-        normalized
-    )
+    m = COUNT_STATE_RE.search(normalized)
     if not m:
         raise RuntimeError("Không trích xuất được biến count/state")
 
     state, cur_state = m.group(2), m.group(3)
 
-    # Match: UPDATETEXT(STATE.text);UPDATEOFFSET(STATE.offset)
-    m2 = re.search(
-        rf'([\w$]+)\({re.escape(state)}\.text\);([\w$]+)\({re.escape(state)}\.offset\)',
-        block
-    )
+    m2 = next((u for u in UPDATE_RE.finditer(block) if u.group(2) == state), None)
     if not m2:
         raise RuntimeError("Không trích xuất được update functions")
 
-    # Match: INPUT.includes("
-    m3 = re.search(r'([\w$]+)\.includes\("', block)
+    m3 = INPUT_RE.search(block)
     if not m3:
         raise RuntimeError("Không trích xuất được input variable")
 
@@ -123,32 +459,189 @@ def extract_variables(block):
         'state': state,
         'cur_state': cur_state,
         'update_text': m2.group(1),
-        'update_offset': m2.group(2),
+        'update_offset': m2.group(3),
     }
 
 
-def generate_fix(v):
-    """Generate the fix code that does backspace + insert replacement text."""
+# Where a held IME burst waits for the rest of it (see generate_fix)
+PENDING_BURST = 'globalThis.__vnImeBurst'
+# Per-process counters of an instrumented fix (see instrument_fix)
+IME_STATS = 'globalThis.__vnImeStats'
+
+
+def generate_fix(v, coalesce=None, instrument=False):
+    """Generate the fix code that applies an IME burst as one replacement.
+
+    Typed-then-deleted characters cancel out, the remaining deletions go
+    through backspace() and the replacement text is inserted in one call,
+    followed by a single text/offset update.
+
+    Some IMEs send the DELs and the replacement text as separate events.
+    With coalesce (a window in ms, 0 for one microtask) an event that only
+    deletes is held instead of rendered; the replacement arriving within
+    the window is applied on top of it as one edit. A held burst is
+    rendered on its own when the window ends, or just before a control
+    key is handled, which then acts on the text the burst left.
+
+    With instrument, every event the fix handles is also counted and timed
+    (see instrument_fix).
+    """
+    if coalesce is None:
+        condition, body = f'{v["input"]}.includes("\\x7f")', (
+            f'let _r=[],{v["state"]}={v["cur_state"]};'
+            f'for(const _c of {v["input"]})_c==="\\x7f"?_r.pop()??({v["state"]}={v["state"]}.backspace()):_r.push(_c);'
+            f'if(_r.length){v["state"]}={v["state"]}.insert(_r.join(""));'
+            f'if(!{v["cur_state"]}.equals({v["state"]})){{'
+            f'if({v["cur_state"]}.text!=={v["state"]}.text)'
+            f'{v["update_text"]}({v["state"]}.text);'
+            f'{v["update_offset"]}({v["state"]}.offset)'
+            f'}}return;'
+        )
+    else:
+        condition, body = coalescing_fix(v, coalesce)
+    if instrument:
+        body = instrument_fix(v, body)
+    return f'{PATCH_MARKER}if({condition}){{{body}}}'
+
+
+def coalescing_fix(v, coalesce):
+    """(condition, body) of the fix holding DEL-only bursts for coalesce ms."""
+    i, s, c = v['input'], v['state'], v['cur_state']
+    held = PENDING_BURST
+    schedule = f'setTimeout(_g,{int(coalesce)})' if coalesce else 'queueMicrotask(_g)'
+    return f'{i}.includes("\\x7f")||{held}', (
+        f'let _p={held},_r=[];{held}=null;'
+        f'const _f=_s=>{{if(!{c}.equals(_s)){{if({c}.text!==_s.text){v["update_text"]}(_s.text);'
+        f'{v["update_offset"]}(_s.offset)}}}};'
+        # A burst held against another cursor state is stale: drop it
+        f'if(_p&&(clearTimeout(_p.t),!_p.c.equals({c})))_p=null;'
+        f'if({i}.includes("\\x7f")||_p&&{i}&&!/[\\x00-\\x1f]/.test({i})){{'
+        f'let {s}=_p?_p.s:{c};'
+        f'for(const _c of {i})_c==="\\x7f"?_r.pop()??({s}={s}.backspace()):_r.push(_c);'
+        f'if(!_r.length){{const _q={{c:{c},s:{s}}},_g=()=>{{if({held}===_q){{{held}=null;_f(_q.s)}}}};'
+        f'_q.t={schedule};{held}=_q;return}}'
+        f'{s}={s}.insert(_r.join(""));_f({s});return}}'
+        # Anything else renders the held burst first, then runs as usual on
+        # the cursor it left; the handler's cursor binding may be const, so
+        # the object itself is brought up to date
+        f'_p&&(_f(_p.s),Object.assign({c},_p.s))'
+    )
+
+
+def instrument_fix(v, body):
+    """Fix body that also counts and times each event it handles.
+
+    Counters and the latency histogram (STATS_BUCKETS power-of-two µs
+    buckets) live on one object per process; on exit it is appended as a
+    JSON line to the stats file, for report_stats() to summarise. The file
+    is found the way stats_path() finds it, from the environment of the
+    running process, so the patched file works for any user. cli.js is an
+    ES module: fs comes from process.getBuiltinModule() or, on runtimes
+    without it, an import() started with the first event.
+    """
+    # cache_dir()'s base directory, from the process environment _v
+    base = (
+        'process.platform==="win32"?_v.LOCALAPPDATA||_v.USERPROFILE&&_v.USERPROFILE+"/AppData/Local"'
+        ':_v.XDG_CACHE_HOME||_v.HOME&&_v.HOME+"/.cache"'
+    )
     return (
-        f'{PATCH_MARKER}'
-        f'if({v["input"]}.includes("\\x7f")){{'
-        f'let _n=({v["input"]}.match(/\\x7f/g)||[]).length,'
-        f'_vn={v["input"]}.replace(/\\x7f/g,""),'
-        f'{v["state"]}={v["cur_state"]};'
-        f'for(let _i=0;_i<_n;_i++){v["state"]}={v["state"]}.backspace();'
-        f'for(const _c of _vn){v["state"]}={v["state"]}.insert(_c);'
-        f'if(!{v["cur_state"]}.equals({v["state"]})){{'
-        f'if({v["cur_state"]}.text!=={v["state"]}.text)'
-        f'{v["update_text"]}({v["state"]}.text);'
-        f'{v["update_offset"]}({v["state"]}.offset)'
-        f'}}return;}}'
+        f'const _t=performance.now();try{{{body}}}finally{{'
+        f'const _e=(performance.now()-_t)*1e3;let _m={IME_STATS};'
+        f'if(!_m){{_m={IME_STATS}={{events:0,dels:0,hist:Array({STATS_BUCKETS}).fill(0),start:Date.now()}};'
+        f'const _v=process.env,_h={base},_d=_v.CLAUDE_VN_FIX_CACHE_DIR||_h&&_h+"/claude-vn-fix";'
+        f'let _w=process.getBuiltinModule?.("fs");_w||import("node:fs").then(_f=>{{_w=_f}},()=>{{}});'
+        f'process.once("exit",()=>{{try{{_w.mkdirSync(_d,{{recursive:true}});'
+        f'_w.appendFileSync(_d+{json.dumps("/" + STATS_FILE)},JSON.stringify({{pid:process.pid,'
+        f'script:process.argv[1],..._m,end:Date.now()}})+"\\n")}}catch{{}}}})}}'
+        f'_m.events++;for(let _k=-1;(_k={v["input"]}.indexOf("\\x7f",_k+1))>=0;)_m.dels++;'
+        f'_m.hist[Math.min({STATS_BUCKETS - 1},32-Math.clz32(_e))]++}}'
     )
 
 
+def fix_block(block, variables=None, coalesce=None, instrument=False):
+    """Fix code for a bug block, padded to its length so nothing has to move."""
+    fix_code = generate_fix(variables or extract_variables(block), coalesce, instrument).encode('utf-8')
+    return fix_code + b' ' * max(0, len(block) - len(fix_code))
+
+
+# The only pattern so far; lex_bug_blocks() already bounds its if-block exactly
+add_rule(
+    'npm', 'if-block', BUG_PATTERN,
+    lambda block, hit, lo, hi: (lo, hi), fix_block,
+)
+
+# Offset cache: entries are only valid for the fix template that produced them
+def fix_salt(coalesce=None, instrument=False):
+    """Cache/state salt of the fix template patch() emits for these options."""
+    return 'npm-' + hashlib.sha256(generate_fix({
+        k: k for k in ('input', 'state', 'cur_state', 'update_text', 'update_offset')
+    }, coalesce, instrument).encode('utf-8')).hexdigest()[:8]
+
+
+def detect_version(file_path):
+    """Claude Code version from the package.json next to cli.js, or None."""
+    try:
+        with open(Path(file_path).parent / 'package.json', 'r', encoding='utf-8') as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def cached_fixes(key, file_path):
+    """Return the [(block_start, block_end, block, fix_code)] cached for key, or None.
+
+    Every cached block must still be found verbatim at its offset; a stale
+    entry is dropped so the caller falls back to a full search.
+    """
+    entry = cache_lookup(key)
+    if not entry:
+        return None
+
+    fixes = []
+    for block_start, _, block, fix_code in entry:
+        block, fix_code = bytes.fromhex(block), bytes.fromhex(fix_code)
+        block_end = block_start + len(block)
+        if read_range(file_path, block_start, block_end) != block:
+            cache_forget(key)
+            return None
+        fixes.append((block_start, block_end, block, fix_code))
+    return fixes
+
+
+def located_variables(located):
+    """Variable names of every located (block_start, block_end, block), printed as found."""
+    found = []
+    for block_start, _, block in located:
+        variables = extract_variables(block)
+        print(f"   Vars @{block_start}: input={variables['input']}, "
+              f"state={variables['state']}, cur={variables['cur_state']}")
+        found.append(variables)
+    return found
+
+
+def plan_fixes(located, found, coalesce=None, instrument=False):
+    """Fix every located block with its variables from located_variables().
+
+    Returns [(block_start, block_end, block, fix_code)].
+    """
+    return [
+        (block_start, block_end, block, fix_block(block, variables, coalesce, instrument))
+        for (block_start, block_end, block), variables in zip(located, found)
+    ]
+
+
 def find_latest_backup(file_path):
     """Find the most recent backup file."""
+    # Content-addressed store: found through its index, no directory listing
+    backup = latest_backup(file_path)
+    if backup:
+        return backup
+
+    # *.backup-<timestamp> copies written by older versions
     dir_path = os.path.dirname(file_path)
     filename = os.path.basename(file_path)
+    if not os.path.isdir(dir_path or '.'):
+        return None
     backups = [
         os.path.join(dir_path, f) for f in os.listdir(dir_path or '.')
         if f.startswith(f"{filename}.backup-")
@@ -159,49 +652,95 @@ def find_latest_backup(file_path):
     return backups[0]
 
 
-def patch(file_path):
-    """Apply Vietnamese IME fix to cli.js."""
+@locked
+def patch(file_path, use_cache=True, backup=False, keep=BACKUP_KEEP, max_age_days=None,
+          coalesce=None, instrument=False):
+    """Apply Vietnamese IME fix to cli.js (see generate_fix for the options)."""
     print(f"-> File: {file_path}")
 
     if not os.path.exists(file_path):
         print(f"Lỗi: File không tồn tại: {file_path}", file=sys.stderr)
         return 1
 
-    # Read
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    # Patched by an earlier run, e.g. the one this run waited for: one stat
+    if patch_status(file_path) == STATE_PATCHED:
+        print("Đã patch trước đó.")
+        return 0
 
-    # Already patched?
-    if PATCH_MARKER in content:
+    # Known build? Its cached block offsets are checked instead of lexing
+    version = detect_version(file_path)
+    rules = rules_for('npm', version)
+    salt = fix_salt(coalesce, instrument)
+    with phase('cache'):
+        cache_key = file_fingerprint(file_path, version, salt)
+        fixes = cached_fixes(cache_key, file_path) if use_cache else None
+
+    # Already patched? cli.js is read once, never loaded whole: the same
+    # blocks are hashed, copied to the backup and, unless cached, lexed
+    staged = start_backup(file_path) if backup else None
+    with phase('read' if fixes else 'scan', os.path.getsize(file_path)):
+        patched, located, sha256 = read_patch_state(file_path, rules, staged, locate=not fixes)
+    if patched:
+        discard_backup(staged)
         print("Đã patch trước đó.")
+        write_state(file_path, version, salt)
         return 0
 
-    # Backup
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    backup_path = f"{file_path}.backup-{timestamp}"
-    shutil.copy2(file_path, backup_path)
-    print(f"   Backup: {backup_path}")
+    journal = None
+    committed = False
 
     try:
-        # Find bug block
-        block_start, block_end, block = find_bug_block(content)
-
-        # Extract variables
-        variables = extract_variables(block)
-        print(f"   Vars: input={variables['input']}, state={variables['state']}, cur={variables['cur_state']}")
-
-        # Generate fix and replace
-        fix_code = generate_fix(variables)
-        patched = content[:block_start] + fix_code + content[block_end:]
-
-        # Write
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(patched)
-
-        # Verify
-        with open(file_path, 'r', encoding='utf-8') as f:
-            if PATCH_MARKER not in f.read():
-                raise RuntimeError("Verify failed: patch marker not found after write")
+        if fixes:
+            print(f"   Cache: {len(fixes)} block đã biết, bỏ qua tìm kiếm")
+        else:
+            if not located:
+                raise RuntimeError(BUG_NOT_FOUND)
+            print(f"   Found {len(located)} bug block(s)")
+
+            # Extract variables
+            with phase('extract', sum(len(block) for *_, block in located)):
+                found = located_variables(located)
+
+            # Generate each fix; pad a shorter one so nothing after it has to move
+            with phase('generate') as record:
+                fixes = plan_fixes(located, found, coalesce, instrument)
+                record['bytes'] = sum(len(fix_code) for *_, fix_code in fixes)
+
+        # Journal entries are at their offsets in the patched file
+        entries = shift_offsets([(block_start, block, fix_code) for block_start, _, block, fix_code in fixes])
+
+        # Full backup into the content-addressed store, if asked for
+        with phase('backup'):
+            if backup:
+                blob, how = store_backup(file_path, sha256, keep, max_age_days, staged)
+                print(f"   Backup: {blob} ({how})")
+
+            # Journal the original blocks instead of backing up the whole file
+            journal = write_journal(file_path, entries, sha256)
+            print(f"   Journal: {journal}")
+
+        # Write cli.js with every fix into a private copy in one pass and
+        # check it; only then does it replace cli.js, in one rename
+        with atomic_update(file_path, copy=False) as tmp:
+            with phase('write', os.path.getsize(file_path)):
+                rewrite_file(file_path, tmp, [(start, end, fix_code) for start, end, _, fix_code in fixes])
+
+            # Verify: read back only the fixed regions
+            with phase('verify', sum(len(fix_code) for *_, fix_code in entries)):
+                for offset, _, fix_code in entries:
+                    if read_range(tmp, offset, offset + len(fix_code)) != fix_code:
+                        raise RuntimeError("Verify failed: fix code not found after write")
+        print(f"   Patched {len(entries)} location(s)")
+        committed = True
+
+        if use_cache:
+            cache_store(cache_key, [
+                [block_start, 'if-block', block.hex(), fix_code.hex()]
+                for block_start, _, block, fix_code in fixes
+            ])
+
+        # Recorded last, once nothing else will touch the file
+        write_state(file_path, version, salt)
 
         print("\n   Patch thành công! Khởi động lại Claude Code.\n")
         return 0
@@ -209,35 +748,135 @@ def patch(file_path):
     except Exception as e:
         print(f"\nLỗi: {e}", file=sys.stderr)
         print("Báo lỗi tại: https://github.com/manhit96/claude-code-vietnamese-fix/issues", file=sys.stderr)
-        # Rollback
-        if os.path.exists(backup_path):
-            shutil.copy2(backup_path, file_path)
-            os.remove(backup_path)
-            print("Đã rollback về bản gốc.", file=sys.stderr)
+        discard_backup(staged)
+        # Nothing reached cli.js before the rename, so there is nothing to roll back
+        if journal and not committed:
+            discard_journal(file_path)
+            print("File gốc không bị thay đổi.", file=sys.stderr)
         return 1
 
 
-def restore(file_path):
-    """Restore file from latest backup."""
+@locked
+def restore(file_path, verify=False):
+    """Restore file from its journal, or from the latest backup."""
+    journal = load_journal(file_path)
+    if journal is not None:
+        restore_journal(file_path, journal, verify=verify)
+        clear_state(file_path)
+        print(f"Đã khôi phục từ journal: {journal_path(file_path)}")
+        print("Khởi động lại Claude Code.")
+        return 0
+
+    # Full-file backups made by older versions of the patcher
     backup = find_latest_backup(file_path)
     if not backup:
         print(f"Không tìm thấy backup cho {file_path}", file=sys.stderr)
         return 1
 
-    shutil.copy2(backup, file_path)
+    replace_from(backup, file_path)
+    clear_state(file_path)
     print(f"Đã khôi phục từ: {backup}")
     print("Khởi động lại Claude Code.")
     return 0
 
 
+def export_patch(file_path, out_path, use_cache=True, coalesce=None, instrument=False):
+    """Work out the patch of an unpatched cli.js and save it as an artifact."""
+    version = detect_version(file_path)
+    rules = rules_for('npm', version)
+    salt = fix_salt(coalesce, instrument)
+    cache_key = file_fingerprint(file_path, version, salt)
+    fixes = cached_fixes(cache_key, file_path) if use_cache else None
+    patched, located, sha256 = read_patch_state(file_path, rules, locate=not fixes)
+    if patched:
+        print("Lỗi: File đã được patch, cần bản gốc để export", file=sys.stderr)
+        return 1
+
+    if not fixes:
+        if not located:
+            raise RuntimeError(BUG_NOT_FOUND)
+        fixes = plan_fixes(located, located_variables(located), coalesce, instrument)
+
+    write_artifact(
+        out_path, 'npm', file_path, sha256, version, salt,
+        [(block_start, block, fix_code) for block_start, _, block, fix_code in fixes],
+    )
+    print(f"Đã export {len(fixes)} block: {out_path}")
+    return 0
+
+
+@locked
+def apply_patch(file_path, artifact_path, verify=False):
+    """Apply an exported artifact: check the build, splice, no search."""
+    print(f"-> File: {file_path}")
+    artifact = load_artifact(artifact_path, 'npm')
+
+    if artifact_applied(file_path, artifact):
+        print("Đã patch trước đó.")
+        write_state(file_path, artifact['version'], artifact['fix'])
+        return 0
+
+    with phase('check', sum(len(original) for _, original, _ in artifact['entries'])):
+        sha256 = check_artifact(file_path, artifact, verify)
+
+    # Offsets are into the unpatched file: shift each by the growth before it
+    entries = shift_offsets(artifact['entries'])
+
+    journal = write_journal(file_path, entries, sha256)
+    try:
+        with atomic_update(file_path, copy=False) as tmp:
+            with phase('write', os.path.getsize(file_path)):
+                rewrite_file(file_path, tmp, [
+                    (offset, offset + len(original), fix_code)
+                    for offset, original, fix_code in artifact['entries']
+                ])
+            with phase('verify', sum(len(fix_code) for *_, fix_code in entries)):
+                for offset, _, fix_code in entries:
+                    if read_range(tmp, offset, offset + len(fix_code)) != fix_code:
+                        raise RuntimeError("Verify failed: fix code not found after write")
+    except Exception:
+        discard_journal(file_path)
+        raise
+
+    write_state(file_path, artifact['version'], artifact['fix'])
+    print(f"   Journal: {journal}")
+    print("\n   Patch thành công! Khởi động lại Claude Code.\n")
+    return 0
+
+
 def show_help():
     """Hiển thị hướng dẫn sử dụng."""
     print("Claude Code Vietnamese IME Fix")
     print("")
     print("Sử dụng:")
     print("  python3 patcher.py              Tự động phát hiện và fix")
-    print("  python3 patcher.py --restore    Khôi phục từ backup")
+    print("  python3 patcher.py --restore    Khôi phục từ journal/backup")
+    print("  python3 patcher.py --restore --verify")
+    print("                                  Kiểm tra thêm checksum toàn file")
     print("  python3 patcher.py --path FILE  Fix file cụ thể")
+    print("  python3 patcher.py --no-cache   Bỏ qua cache offset, luôn tìm lại")
+    print("  python3 patcher.py --timings    In bảng thời gian từng bước")
+    print("  python3 patcher.py --json       Số liệu từng bước dạng JSON (stdout)")
+    print("  python3 patcher.py --status     Trạng thái patch (exit 0/1/2), không scan file")
+    print("  python3 patcher.py --list       Liệt kê mọi bản cài npm tìm thấy")
+    print("  python3 patcher.py --all        Fix mọi bản npm và Bun binary, song song")
+    print("    --jobs N                      Số tiến trình chạy song song (mặc định: số CPU)")
+    print("  python3 patcher.py --watch      Chạy nền, tự patch lại sau khi Claude Code cập nhật")
+    print("    --poll / --interval S         Dùng polling thay inotify / chu kỳ polling (mặc định 2s)")
+    print("  python3 patcher.py --no-wait    Bỏ qua nếu tiến trình khác đang patch (mặc định: chờ)")
+    print("  python3 patcher.py --coalesce MS")
+    print("                                  Gộp backspace và ký tự thay thế đến trong MS ms (0: cùng tick)")
+    print("  python3 patcher.py --instrument Đếm và đo thời gian xử lý sự kiện IME, ghi ra file khi thoát")
+    print("  python3 patcher.py --report     Tổng kết số liệu --instrument (thêm --json)")
+    print("  python3 patcher.py --export FILE")
+    print("                                  Lưu patch thành artifact dùng cho máy khác")
+    print("  python3 patcher.py --apply FILE")
+    print("                                  Áp dụng artifact cho bản build giống hệt, không scan")
+    print("    --verify                      Kiểm tra thêm sha256 toàn file trước khi ghi")
+    print("  python3 patcher.py --backup     Lưu thêm bản sao đầy đủ (dedup, reflink)")
+    print("  python3 patcher.py --prune-backups")
+    print("                                  Gom backup cũ vào store, áp dụng retention")
+    print("    --keep N / --max-age DAYS     Retention: giữ N bản / bỏ bản cũ hơn DAYS ngày")
     print("  python3 patcher.py --help       Hiển thị hướng dẫn")
     print("")
     print("https://github.com/manhit96/claude-code-vietnamese-fix")
@@ -250,6 +889,16 @@ def main():
         show_help()
         return 0
 
+    # Field data written by instrumented fixes; needs no install
+    if '--report' in args:
+        return report_stats(as_json='--json' in args)
+
+    if '--list' in args:
+        installs = find_all_cli_js(use_index='--no-cache' not in args)
+        for cli_js in installs:
+            print(f"{detect_version(cli_js) or '?':>10}  {cli_js}")
+        return 0 if installs else 1
+
     # Parse --restore flag
     if '--restore' in args:
         args.remove('--restore')
@@ -259,18 +908,86 @@ def main():
             idx = args.index('--path')
             file_path = args[idx + 1]
         else:
-            file_path = find_cli_js()
-        return restore(file_path)
+            with phase('discover'):
+                file_path = find_cli_js()
+        return run_measured(
+            restore, file_path, as_json='--json' in args, timings='--timings' in args,
+            verify='--verify' in args, wait='--no-wait' not in args,
+        )
 
     # Get path from --path or auto-detect
     file_path = None
     if '--path' in args:
         idx = args.index('--path')
         file_path = args[idx + 1]
-    else:
-        file_path = find_cli_js()
+    elif '--all' not in args and '--watch' not in args:
+        with phase('discover'):
+            file_path = find_cli_js()
+
+    # O(1) check against the state record, no scan
+    if '--status' in args:
+        return show_status(file_path)
 
-    return patch(file_path)
+    # IME bursts split across events: held up to this many ms (npm only)
+    coalesce = int(args[args.index('--coalesce') + 1]) if '--coalesce' in args else None
+    instrument = '--instrument' in args
+
+    # Portable patches: worked out once, applied to identical builds unscanned
+    if '--export' in args:
+        return export_patch(
+            file_path, args[args.index('--export') + 1],
+            use_cache='--no-cache' not in args, coalesce=coalesce, instrument=instrument,
+        )
+    if '--apply' in args:
+        return run_measured(
+            apply_patch, file_path, as_json='--json' in args, timings='--timings' in args,
+            artifact_path=args[args.index('--apply') + 1], verify='--verify' in args,
+            wait='--no-wait' not in args,
+        )
+
+    # Backup retention
+    keep = int(args[args.index('--keep') + 1]) if '--keep' in args else BACKUP_KEEP
+    max_age_days = float(args[args.index('--max-age') + 1]) if '--max-age' in args else None
+
+    # Patch every npm install and Bun binary found, concurrently
+    if '--all' in args:
+        from patcher_bun import find_all_bun_binaries
+
+        jobs = int(args[args.index('--jobs') + 1]) if '--jobs' in args else None
+        targets = [('npm', path) for path in find_all_cli_js(use_index='--no-cache' not in args)]
+        targets += [('bun', path) for path in find_all_bun_binaries()]
+        return run_fleet(
+            targets, jobs, use_cache='--no-cache' not in args,
+            backup='--backup' in args, keep=keep, max_age_days=max_age_days,
+            wait='--no-wait' not in args,
+        )
+
+    # Stay running and re-patch whenever an update replaces a target
+    if '--watch' in args:
+        from patcher_bun import find_all_bun_binaries
+
+        def discover():
+            if file_path:
+                return [('npm', file_path)]
+            return (
+                [('npm', path) for path in find_all_cli_js()]
+                + [('bun', path) for path in find_all_bun_binaries()]
+            )
+
+        interval = float(args[args.index('--interval') + 1]) if '--interval' in args else 2.0
+        return watch(discover, interval, poll='--poll' in args)
+
+    if '--prune-backups' in args:
+        freed = prune_backups(file_path, keep, max_age_days)
+        print(f"Đã dọn backup, giải phóng {freed / 1e6:.1f} MB")
+        return 0
+
+    return run_measured(
+        patch, file_path, as_json='--json' in args, timings='--timings' in args,
+        use_cache='--no-cache' not in args,
+        backup='--backup' in args, keep=keep, max_age_days=max_age_days,
+        coalesce=coalesce, instrument=instrument, wait='--no-wait' not in args,
+    )
 
 
 if __name__ == '__main__':
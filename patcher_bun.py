@@ -7,8 +7,21 @@ by patching the binary directly.
 
 Usage:
   python3 patcher_bun.py              Auto-detect and fix
-  python3 patcher_bun.py --restore    Restore from backup
+  python3 patcher_bun.py --restore    Restore from journal/backup
+  python3 patcher_bun.py --restore --verify
+                                      Also check the full-file checksum
   python3 patcher_bun.py --path FILE  Fix specific binary
+  python3 patcher_bun.py --no-cache   Always rescan, ignore cached offsets
+  python3 patcher_bun.py --timings    Print a per-phase timing table
+  python3 patcher_bun.py --json       Per-phase metrics as JSON on stdout
+  python3 patcher_bun.py --status     patched/unpatched/changed, one stat, no scan
+  python3 patcher_bun.py --all        Fix every Bun binary found, in parallel
+  python3 patcher_bun.py --watch      Stay running, re-patch after auto-updates
+  python3 patcher_bun.py --no-wait    Skip the target if another run is patching it
+  python3 patcher_bun.py --export FILE
+                                      Save the patch as a portable artifact
+  python3 patcher_bun.py --apply FILE
+                                      Apply an artifact to an identical build, no scan
 
 Repository: https://github.com/manhit96/claude-code-vietnamese-fix
 License: MIT
@@ -17,11 +30,25 @@ License: MIT
 import os
 import re
 import sys
-import shutil
+import mmap
+import struct
+import hashlib
 import platform
 import subprocess
 from pathlib import Path
-from datetime import datetime
+
+from patcher_common import (
+    CHUNK_SIZE, stream_scan, tee_scan,
+    file_fingerprint, cache_lookup, cache_store, cache_forget, cached_sha256,
+    file_sha256, write_journal, load_journal, restore_journal,
+    discard_journal, journal_path,
+    PATCH_RULES, add_rule, find_rule, rules_for, rules_overlap, scan_rules,
+    write_artifact, load_artifact, check_artifact, artifact_applied,
+    BACKUP_KEEP, start_backup, discard_backup, store_backup, latest_backup, replace_from, prune_backups,
+    run_fleet, phase, run_measured,
+    write_state, clear_state, show_status, patch_status, STATE_PATCHED, watch,
+    locked, atomic_update,
+)
 
 PATCH_MARKER = b"/* VN-IME-FIX */"
 
@@ -38,7 +65,7 @@ BUG_PATTERN = (
 
 FIX_CODE = (
     b'if(!DT.backspace&&!DT.delete&&RT.includes("\\x7F")){'
-    b'let s=b;for(let c of RT)c==="\\x7f"?s=s.backspace():s=s.insert(c);'
+    b'let s=b,r=[];for(let c of RT)"\\x7f"==c?r.pop()??(s=s.backspace()):r.push(c);s=s.insert(r.join(""));'
     b'if(!b.equals(s)){if(b.text!==s.text)R(s.text);w(s.offset)}'
     b'WyT(),QyT();return}'
 )
@@ -67,32 +94,105 @@ BUG_PATTERN_NEW = (
     b'if($H.ctrl)return jH($H.key);if($H.meta)return YH($H.key);if(ot4.has($H.key))return;if(ZH.length===0)return;if(p.isAtStart()&&lK9(ZH))return p.insert(ZH).left();return p.insert(ZH)}'
 )
 
-# Fix: compact switch cases to free ~92 bytes, use the space for the IME check.
-# Semantically equivalent transformations applied to up/down, backspace, delete,
-# home/end, pagedown/pageup, and the tail condition chain.
+# Fix: compact switch cases to free room for the IME check. Semantically
+# equivalent transformations applied to every case (`if(c)return;return x`
+# becomes `return c?void 0:x`) and to the tail condition chain.
+# An IME burst ("\x7f" deletions followed by the replacement text) is netted
+# first: typed-then-deleted characters cancel out, the remaining deletions go
+# through backspace() and the replacement is inserted in one call, so a burst
+# builds one cursor per net deletion plus one, not one per character. Like
+# the original fix, a burst returns straight away and never takes the
+# isAtStart()/lK9() paste path; one that only deletes inserts nothing.
 FIX_CODE_NEW = (
     b'function t($H,ZH){switch($H.key){'
-    b'case"escape":if(X)return;return Q(),p;'
-    b'case"left":if($H.ctrl||$H.meta||$H.fn)return p.prevWord();if(T&&!$H.shift&&p.text==="")return T(),p;return p.left();'
+    b'case"escape":return X?void 0:(Q(),p);'
+    b'case"left":if($H.ctrl||$H.meta||$H.fn)return p.prevWord();return T&&!$H.shift&&!p.text?(T(),p):p.left();'
     b'case"right":if($H.ctrl||$H.meta||$H.fn)return p.nextWord();return p.right();'
-    b'case"up":case"down":if($H.shift||$H.ctrl||$H.meta)return;return $H.key==="up"?e():s();'
+    b'case"up":case"down":return $H.shift||$H.ctrl||$H.meta?void 0:$H.key=="up"?e():s();'
     b'case"backspace":return $H.superKey?TH():$H.meta||$H.ctrl?HH():p.deleteTokenBefore()??p.backspace();'
     b'case"delete":return $H.superKey||$H.meta?_H():p.del();'
-    b'case"home":case"end":if($H.ctrl)return;return p[$H.key==="home"?"startOfLine":"endOfLine"]();'
-    b'case"pagedown":case"pageup":if(Uq()||$H.ctrl)return;return p[$H.key==="pagedown"?"endOfLine":"startOfLine"]();'
-    b'case"return":if($H.ctrl)return;return wH($H);'
+    b'case"home":case"end":return $H.ctrl?void 0:p[$H.key=="home"?"startOfLine":"endOfLine"]();'
+    b'case"pagedown":case"pageup":return Uq()||$H.ctrl?void 0:p[$H.key=="pagedown"?"endOfLine":"startOfLine"]();'
+    b'case"return":return $H.ctrl?void 0:wH($H);'
     b'case"enter":return p.insert(`\n`);'
     b'case"tab":return}'
-    b'if($H.ctrl)return jH($H.key);if($H.meta)return YH($H.key);'
+    b'if($H.ctrl||$H.meta)return($H.ctrl?jH:YH)($H.key);'
     b'if(ot4.has($H.key)||!ZH)return;'
     b'/* VN-IME-FIX */'
-    b'if(ZH.includes("\\x7f"))return[...ZH].reduce((s,c)=>"\\x7f"==c?s.backspace():s.insert(c),p);'
+    b'if(ZH.includes("\\x7f")){let u=p,r=[];for(let c of ZH)"\\x7f"==c?r.pop()??(u=u.backspace()):r.push(c);'
+    b'return r[0]?u.insert(r.join("")):u}'
     b'return p.isAtStart()&&lK9(ZH)?p.insert(ZH).left():p.insert(ZH)}'
 )
 
+# ── Single-pass scanner ───────────────────────────────────────────────────────
+# Pattern IDs reported with every hit.
+PATTERN_NEW = 'new'              # BUG_PATTERN_NEW, exact
+PATTERN_LEGACY = 'legacy'        # BUG_PATTERN, exact
+PATTERN_LEGACY_RE = 'legacy-re'  # legacy handler with different variable names
+
+# Legacy handler with any minified variable names (BUG_PATTERN is one instance).
+LEGACY_RE = re.compile(
+    rb'if\(!([\w$]+)\.backspace&&!\1\.delete&&([\w$]+)\.includes\("\\x7F"\)\){'
+    rb'let ([\w$]+)=\(\2\.match\(/\\x7f/g\)\|\|\[\]\)\.length,([\w$]+)=([\w$]+);'
+    rb'for\(let ([\w$]+)=0;\6<\3;\6\+\+\)\4=\4\.deleteTokenBefore\(\)\?\?\4\.backspace\(\);'
+    rb'if\(!\5\.equals\(\4\)\){if\(\5\.text!==\4\.text\)([\w$]+)\(\4\.text\);([\w$]+)\(\4\.offset\)}'
+    rb'([\w$]+)\(\),([\w$]+)\(\);return}'
+)
 
-def find_bun_binary():
-    """Auto-detect Claude Code Bun binary location."""
+# Every pattern family calls .backspace() exactly once, so their rules share
+# it as anchor: one literal search prefilters candidates for all families in
+# a single sweep, and each candidate is confirmed against the full pattern.
+SCAN_ANCHOR = b'.backspace()'
+
+# Max distance from the anchor back to the start of a legacy if(, and on
+# to its end
+LEGACY_LOOKBEHIND = 256
+
+# Pseudo pattern IDs reported by scan_patch_state(): PATCH_MARKER hits, and
+# the version string of the bundled Claude Code (its build info object)
+PATTERN_MARKER = 'marker'
+PATTERN_VERSION = 'version'
+VERSION_ANCHOR = b'README_URL:'
+EMBEDDED_VERSION_RE = re.compile(rb'README_URL:\s*"[^"]*",\s*VERSION:\s*"(\d+\.\d+\.\d+)')
+
+# Offset cache: entries are only valid for the fix code that produced them
+CACHE_SALT = 'bun-' + hashlib.sha256(FIX_CODE_NEW + FIX_CODE).hexdigest()[:8]
+VERSION_RE = re.compile(r'^\d+\.\d+\.\d+')
+
+BUG_NOT_FOUND = (
+    'Không tìm thấy bug pattern trong binary.\n'
+    'Claude Code có thể đã được Anthropic fix hoặc đây không phải Bun binary.'
+)
+
+
+# ── Executable layout ─────────────────────────────────────────────────────────
+# Bun keeps the bundled JavaScript in a section of its own (__BUN,__bun on
+# Mach-O, .bun on PE and newer ELF builds). Older ELF builds append it to the
+# file instead, closed by BUN_TRAILER and the u64 size of the appended data.
+MAGIC_ELF = b'\x7fELF'
+MAGIC_MACHO_64 = b'\xcf\xfa\xed\xfe'
+MAGIC_MACHO_FAT = b'\xca\xfe\xba\xbe'
+MAGIC_PE = (b'MZ\x90\x00', b'MZ\x00\x00')
+BUN_SECTION = b'.bun'
+BUN_MACHO_SEGMENT = b'__BUN'
+BUN_TRAILER = b'\n---- Bun! ----\n'
+
+
+def is_native_binary(path):
+    """True if path starts with a Mach-O, ELF or PE magic number."""
+    # Verify it's a binary (not a shell script or symlink to npm)
+    with open(path, 'rb') as f:
+        header = f.read(4)
+    # Mach-O (macOS), ELF (Linux), or MZ (Windows)
+    return header[:4] in (MAGIC_MACHO_64, MAGIC_MACHO_FAT, MAGIC_ELF) + MAGIC_PE
+
+
+def find_all_bun_binaries():
+    """Find every Claude Code Bun binary, the usual launcher locations first.
+
+    Builds kept by the native installer under ~/.local/share/claude/versions
+    are included; paths resolving to the same file are listed once.
+    """
     home = Path.home()
     is_windows = platform.system() == 'Windows'
 
@@ -108,16 +208,29 @@ def find_bun_binary():
             Path('/opt/homebrew/bin/claude'),
         ]
 
+    versions_dir = home / '.local' / 'share' / 'claude' / 'versions'
+    if versions_dir.is_dir():
+        candidates += sorted(versions_dir.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+
+    found, seen = [], set()
     for path in candidates:
-        if path.exists() and path.is_file():
-            # Verify it's a binary (not a shell script or symlink to npm)
-            with open(path, 'rb') as f:
-                header = f.read(4)
-                # Mach-O (macOS), ELF (Linux), or MZ (Windows)
-                if header[:4] in [b'\xcf\xfa\xed\xfe', b'\xca\xfe\xba\xbe',  # Mach-O
-                                   b'\x7fELF',  # ELF
-                                   b'MZ\x90\x00', b'MZ\x00\x00']:  # Windows PE
-                    return str(path)
+        try:
+            if not path.is_file() or not is_native_binary(path):
+                continue
+        except OSError:
+            continue
+        real = os.path.realpath(path)
+        if real not in seen:
+            seen.add(real)
+            found.append(str(path))
+    return found
+
+
+def find_bun_binary():
+    """Auto-detect Claude Code Bun binary location."""
+    binaries = find_all_bun_binaries()
+    if binaries:
+        return binaries[0]
 
     raise FileNotFoundError(
         "Không tìm thấy Claude Code binary (Bun).\n"
@@ -125,6 +238,151 @@ def find_bun_binary():
     )
 
 
+def _elf_ranges(f):
+    """Byte range of the .bun section of an ELF file."""
+    f.seek(0)
+    ident = f.read(16)
+    is_64 = ident[4] == 2
+    endian = '<' if ident[5] == 1 else '>'
+
+    if is_64:
+        f.seek(0x28)
+        shoff, = struct.unpack(endian + 'Q', f.read(8))
+        f.seek(0x3A)
+        shentsize, shnum, shstrndx = struct.unpack(endian + 'HHH', f.read(6))
+        sh_fmt, offset_at = endian + 'QQ', 24
+    else:
+        f.seek(0x20)
+        shoff, = struct.unpack(endian + 'I', f.read(4))
+        f.seek(0x2E)
+        shentsize, shnum, shstrndx = struct.unpack(endian + 'HHH', f.read(6))
+        sh_fmt, offset_at = endian + 'II', 16
+
+    def section(index):
+        f.seek(shoff + index * shentsize)
+        header = f.read(shentsize)
+        name, = struct.unpack_from(endian + 'I', header, 0)
+        offset, size = struct.unpack_from(sh_fmt, header, offset_at)
+        return name, offset, size
+
+    _, strtab_offset, strtab_size = section(shstrndx)
+    f.seek(strtab_offset)
+    strtab = f.read(strtab_size)
+
+    for index in range(shnum):
+        name, offset, size = section(index)
+        if strtab[name:strtab.find(b'\0', name)] == BUN_SECTION:
+            return [(offset, offset + size)]
+    return []
+
+
+def _macho_ranges(f, base=0):
+    """Byte range of the __BUN segment of a 64-bit Mach-O image at base."""
+    f.seek(base + 16)
+    ncmds, _ = struct.unpack('<II', f.read(8))
+    pos = base + 32  # sizeof(mach_header_64)
+
+    for _ in range(ncmds):
+        f.seek(pos)
+        cmd, cmdsize = struct.unpack('<II', f.read(8))
+        if cmd == 0x19:  # LC_SEGMENT_64
+            segname = f.read(16).rstrip(b'\0')
+            if segname == BUN_MACHO_SEGMENT:
+                f.seek(pos + 40)
+                fileoff, filesize = struct.unpack('<QQ', f.read(16))
+                return [(base + fileoff, base + fileoff + filesize)]
+        pos += cmdsize
+    return []
+
+
+def _fat_ranges(f):
+    """Byte ranges of the __BUN segment of every slice of a universal binary."""
+    f.seek(4)
+    nfat_arch, = struct.unpack('>I', f.read(4))
+    slices = []
+    for index in range(nfat_arch):
+        f.seek(8 + index * 20 + 8)  # fat_arch.offset
+        offset, _ = struct.unpack('>II', f.read(8))
+        slices.append(offset)
+
+    ranges = []
+    for offset in slices:
+        f.seek(offset)
+        if f.read(4) == MAGIC_MACHO_64:
+            ranges.extend(_macho_ranges(f, offset))
+    return ranges
+
+
+def _pe_ranges(f):
+    """Byte range of the .bun section of a PE file."""
+    f.seek(0x3C)
+    pe_offset, = struct.unpack('<I', f.read(4))
+    f.seek(pe_offset)
+    if f.read(4) != b'PE\0\0':
+        return []
+    _, nsections = struct.unpack('<HH', f.read(4))
+    f.seek(pe_offset + 20)
+    optional_size, = struct.unpack('<H', f.read(2))
+
+    table = pe_offset + 24 + optional_size
+    for index in range(nsections):
+        f.seek(table + index * 40)
+        header = f.read(40)
+        if header[:8].rstrip(b'\0') == BUN_SECTION:
+            raw_size, raw_offset = struct.unpack_from('<II', header, 16)
+            return [(raw_offset, raw_offset + raw_size)]
+    return []
+
+
+def _trailer_ranges(f, size):
+    """Byte range of a bundle appended to the file and closed by BUN_TRAILER."""
+    tail_size = min(size, 4096)
+    f.seek(size - tail_size)
+    tail = f.read(tail_size)
+    idx = tail.rfind(BUN_TRAILER)
+    if idx == -1 or len(tail) - (idx + len(BUN_TRAILER)) < 8:
+        return []
+
+    trailer_end = size - tail_size + idx + len(BUN_TRAILER)
+    total, = struct.unpack_from('<Q', tail, idx + len(BUN_TRAILER))
+    if not 0 < total <= trailer_end:
+        return []
+    return [(trailer_end - total, trailer_end)]
+
+
+def _parse_ranges(parser, *args):
+    """parser(*args), or [] when the headers it reads are malformed."""
+    try:
+        return parser(*args)
+    except (struct.error, ValueError, OSError, IndexError):
+        return []
+
+
+def bundle_ranges(f, size):
+    """Find the byte ranges where Bun stores its bundled JavaScript.
+
+    f is any seekable binary file object (open file, mmap or BytesIO) and
+    size its length. Returns a list of (start, end), or [] when the layout
+    is not recognised and the whole file has to be scanned.
+    """
+    f.seek(0)
+    header = f.read(4)
+    if header == MAGIC_ELF:
+        # A section table that does not parse still leaves the trailer
+        ranges = _parse_ranges(_elf_ranges, f) or _parse_ranges(_trailer_ranges, f, size)
+    elif header == MAGIC_MACHO_64:
+        ranges = _parse_ranges(_macho_ranges, f)
+    elif header == MAGIC_MACHO_FAT:
+        ranges = _parse_ranges(_fat_ranges, f)
+    elif header in MAGIC_PE:
+        ranges = _parse_ranges(_pe_ranges, f)
+    else:
+        ranges = []
+
+    ranges = [(max(0, start), min(end, size)) for start, end in ranges]
+    return [(start, end) for start, end in ranges if start < end]
+
+
 def generate_fix(original_pattern):
     """Generate fix code with same length as original."""
     # New pattern (>= v2.1.114): entire function t body
@@ -132,21 +390,15 @@ def generate_fix(original_pattern):
         fix = FIX_CODE_NEW
     else:
         # Legacy pattern: extract variable names via regex
-        legacy_re = re.compile(
-            rb'if\(!([\w$]+)\.backspace&&!\1\.delete&&([\w$]+)\.includes\("\\x7F"\)\){'
-            rb'let ([\w$]+)=\(\2\.match\(/\\x7f/g\)\|\|\[\]\)\.length,([\w$]+)=([\w$]+);'
-            rb'for\(let ([\w$]+)=0;\6<\3;\6\+\+\)\4=\4\.deleteTokenBefore\(\)\?\?\4\.backspace\(\);'
-            rb'if\(!\5\.equals\(\4\)\){if\(\5\.text!==\4\.text\)([\w$]+)\(\4\.text\);([\w$]+)\(\4\.offset\)}'
-            rb'([\w$]+)\(\),([\w$]+)\(\);return}'
-        )
-        match = legacy_re.match(original_pattern)
+        match = LEGACY_RE.match(original_pattern)
         if not match:
             fix = FIX_CODE
         else:
             dt, rt, _, _, state_var, _, update_text, update_offset, fn1, fn2 = match.groups()
             fix = (
                 b'if(!' + dt + b'.backspace&&!' + dt + b'.delete&&' + rt + b'.includes("\\x7F")){'
-                b'let s=' + state_var + b';for(let c of ' + rt + b')c==="\\x7f"?s=s.backspace():s=s.insert(c);'
+                b'let s=' + state_var + b',r=[];for(let c of ' + rt + b')"\\x7f"==c?r.pop()??(s=s.backspace()):r.push(c);'
+                b's=s.insert(r.join(""));'
                 b'if(!' + state_var + b'.equals(s)){if(' + state_var + b'.text!==s.text)' + update_text + b'(s.text);' + update_offset + b'(s.offset)}'
                 + fn1 + b'(),' + fn2 + b'();return}'
             )
@@ -168,10 +420,34 @@ def generate_fix(original_pattern):
     return fix
 
 
+# Version ranges: the explicit handler is gone from 2.1.114 on, function t()
+# only exists from then on. Exact patterns are tried before the regex.
+add_rule(
+    'bun', PATTERN_NEW, SCAN_ANCHOR, re.compile(re.escape(BUG_PATTERN_NEW)), generate_fix,
+    lookbehind=len(BUG_PATTERN_NEW), length=len(BUG_PATTERN_NEW), since='2.1.114',
+)
+add_rule(
+    'bun', PATTERN_LEGACY, SCAN_ANCHOR, re.compile(re.escape(BUG_PATTERN)), generate_fix,
+    lookbehind=LEGACY_LOOKBEHIND, length=LEGACY_LOOKBEHIND, until='2.1.114',
+)
+add_rule(
+    'bun', PATTERN_LEGACY_RE, SCAN_ANCHOR, LEGACY_RE, generate_fix,
+    lookbehind=LEGACY_LOOKBEHIND, length=LEGACY_LOOKBEHIND, until='2.1.114',
+)
+
+
 def find_latest_backup(file_path):
     """Find the most recent backup file."""
+    # Content-addressed store: found through its index, no directory listing
+    backup = latest_backup(file_path)
+    if backup:
+        return backup
+
+    # *.backup-<timestamp> copies written by older versions
     dir_path = os.path.dirname(file_path)
     filename = os.path.basename(file_path)
+    if not os.path.isdir(dir_path or '.'):
+        return None
     backups = [
         os.path.join(dir_path, f) for f in os.listdir(dir_path or '.')
         if f.startswith(f"{filename}.backup-")
@@ -182,55 +458,207 @@ def find_latest_backup(file_path):
     return backups[0]
 
 
-def find_all_bug_patterns(content):
-    """Find all Vietnamese IME bug patterns in binary."""
-    results = []
+def scan_bug_patterns(content, start=0, end=None, rules=None):
+    """Yield (offset, pattern_id, original_bytes) for every bug pattern.
+
+    Sweeps content[start:end] once for the anchor of rules (all Bun rules
+    by default) and confirms each candidate. Works on bytes and mmap
+    objects alike.
+    """
+    for offset, rule, original in scan_rules(content, rules or PATCH_RULES['bun'], start, end):
+        yield offset, rule['name'], original
 
-    # ── New pattern (>= v2.1.114): entire function t body ─────────────────────
-    start = 0
-    while True:
-        idx = content.find(BUG_PATTERN_NEW, start)
-        if idx == -1:
-            break
-        results.append((idx, BUG_PATTERN_NEW))
-        start = idx + len(BUG_PATTERN_NEW)
 
-    if results:
-        return results
+def scan_patch_state(content, start=0, end=None, rules=None, find_version=True):
+    """Like scan_bug_patterns(), also yielding PATCH_MARKER and version hits.
 
-    # ── Legacy exact match ─────────────────────────────────────────────────────
-    start = 0
-    while True:
-        idx = content.find(BUG_PATTERN, start)
-        if idx == -1:
+    Those are (offset, PATTERN_MARKER, PATCH_MARKER) and, for the first
+    embedded version string, (offset, PATTERN_VERSION, b'x.y.z').
+    """
+    end = len(content) if end is None else end
+    idx = content.find(PATCH_MARKER, start, end)
+    while idx != -1:
+        yield idx, PATTERN_MARKER, PATCH_MARKER
+        idx = content.find(PATCH_MARKER, idx + len(PATCH_MARKER), end)
+
+    idx = content.find(VERSION_ANCHOR, start, end) if find_version else -1
+    while idx != -1:
+        match = EMBEDDED_VERSION_RE.match(content, idx, end)
+        if match:
+            yield idx, PATTERN_VERSION, match.group(1)
             break
-        results.append((idx, BUG_PATTERN))
-        start = idx + len(BUG_PATTERN)
-
-    if results:
-        return results
-
-    # ── Legacy regex fallback (variable name variations) ─────────────────────
-    legacy_re = re.compile(
-        rb'if\(!([\w$]+)\.backspace&&!\1\.delete&&([\w$]+)\.includes\("\\x7F"\)\){'
-        rb'let ([\w$]+)=\(\2\.match\(/\\x7f/g\)\|\|\[\]\)\.length,([\w$]+)=([\w$]+);'
-        rb'for\(let ([\w$]+)=0;\6<\3;\6\+\+\)\4=\4\.deleteTokenBefore\(\)\?\?\4\.backspace\(\);'
-        rb'if\(!\5\.equals\(\4\)\){if\(\5\.text!==\4\.text\)([\w$]+)\(\4\.text\);([\w$]+)\(\4\.offset\)}'
-        rb'([\w$]+)\(\),([\w$]+)\(\);return}'
-    )
-    for match in legacy_re.finditer(content):
-        results.append((match.start(), match.group(0)))
+        idx = content.find(VERSION_ANCHOR, idx + len(VERSION_ANCHOR), end)
 
-    if not results:
-        raise RuntimeError(
-            'Không tìm thấy bug pattern trong binary.\n'
-            'Claude Code có thể đã được Anthropic fix hoặc đây không phải Bun binary.'
-        )
+    yield from scan_bug_patterns(content, start, end, rules)
+
+
+def _state_scan(rules):
+    """scan_patch_state() as a stream_scan() scan; returns (scan, overlap)."""
+    overlap = rules_overlap(rules)
+    version_found = False
+
+    def scan(buf):
+        # The version is only looked for until one is surely reported
+        nonlocal version_found
+        for hit in scan_patch_state(buf, rules=rules, find_version=not version_found):
+            if hit[1] == PATTERN_VERSION and hit[0] < len(buf) - overlap:
+                version_found = True
+            yield hit
+
+    return scan, overlap
+
+
+def iter_patch_state(file_path, chunk_size=CHUNK_SIZE, rules=None):
+    """Stream file_path and yield scan_patch_state() hits with absolute offsets.
+
+    Reads fixed-size chunks of the embedded Bun bundle only, so memory use
+    stays at a few MB and the runtime's machine code is skipped. If the
+    bundle ranges hold no marker or bug at all, the whole file is scanned
+    instead. rules narrows the bug patterns looked for (default: all).
+    """
+    scan, overlap = _state_scan(rules or PATCH_RULES['bun'])
+    with open(file_path, 'rb') as f:
+        ranges = bundle_ranges(f, os.fstat(f.fileno()).st_size)
+
+    found = False
+    for start, end in ranges:
+        for hit in stream_scan(file_path, scan, overlap, chunk_size, start, end):
+            found = found or hit[1] != PATTERN_VERSION
+            yield hit
+
+    if not found:
+        yield from stream_scan(file_path, scan, overlap, chunk_size)
+
+
+def read_patch_state(file_path, rules=None, staged=None):
+    """iter_patch_state() hits plus the file's sha256, from one read.
+
+    The whole file is read once (tee_scan()), since the checksum needs it
+    anyway; the bundle ranges are scanned and the staged backup copied on
+    the way. Returns (hits, sha256).
+    """
+    scan, overlap = _state_scan(rules or PATCH_RULES['bun'])
+    with open(file_path, 'rb') as f:
+        ranges = bundle_ranges(f, os.fstat(f.fileno()).st_size)
+
+    hits, sha256 = tee_scan(file_path, scan, overlap, ranges, staged)
+    if ranges and all(hit[1] == PATTERN_VERSION for hit in hits):
+        # Nothing in the bundle: same whole-file fallback as iter_patch_state()
+        hits += stream_scan(file_path, scan, overlap)
+    return hits, sha256
+
+
+def iter_bug_patterns(file_path, chunk_size=CHUNK_SIZE, rules=None):
+    """Stream file_path and yield (offset, pattern_id, original_bytes)."""
+    for hit in iter_patch_state(file_path, chunk_size, rules):
+        if hit[1] not in (PATTERN_MARKER, PATTERN_VERSION):
+            yield hit
+
+
+def flush_range(mm, offset, length):
+    """Flush only the pages covering mm[offset:offset + length] to disk."""
+    # msync/FlushViewOfFile need an offset aligned to the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mm.flush(start, offset + length - start)
+
+
+def detect_version(file_path):
+    """Best-effort Claude Code version from the install path.
 
-    return results
+    The native installer keeps builds under .../versions/<x.y.z> and links
+    ~/.local/bin/claude to one of them. Returns None when unknown.
+    """
+    for part in reversed(Path(os.path.realpath(file_path)).parts[-2:]):
+        match = VERSION_RE.match(part)
+        if match:
+            return match.group(0)
+    return None
 
 
-def patch(file_path):
+def plan_patches(bug_locations):
+    """Attach the fix to each (offset, pattern_id, original_bytes) location.
+
+    Returns a list of (offset, pattern_id, original_bytes, fix_code).
+    """
+    plan = []
+    for bug_offset, pattern_id, bug_pattern in bug_locations:
+        # Generate fix with the generator of the rule that matched
+        fix_code = find_rule('bun', pattern_id)['fix'](bug_pattern)
+
+        if len(fix_code) != len(bug_pattern):
+            raise RuntimeError(f"Fix code length mismatch at offset {bug_offset}")
+
+        plan.append((bug_offset, pattern_id, bug_pattern, fix_code))
+    return plan
+
+
+def cached_plan(key, file_path):
+    """Return the patch plan cached for key, if file_path still matches it.
+
+    Reads only the expected original bytes at each cached offset. A stale
+    entry is dropped and None returned, so the caller falls back to a scan.
+    """
+    entry = cache_lookup(key)
+    if not entry:
+        return None
+
+    plan = [
+        (offset, pattern_id, bytes.fromhex(original), bytes.fromhex(fix_code))
+        for offset, pattern_id, original, fix_code in entry
+    ]
+    with open(file_path, 'rb') as f:
+        for offset, _, original, fix_code in plan:
+            f.seek(offset)
+            if len(fix_code) != len(original) or f.read(len(original)) != original:
+                cache_forget(key)
+                return None
+    return plan
+
+
+def apply_patches_in_place(mm, plan):
+    """Write each planned fix over its bug location in the mapped file.
+
+    All fixes are length-preserving, so only the matched byte ranges are
+    written and only the pages covering them are flushed.
+    Returns the list of (offset, fix_code) that were written.
+    """
+    written = []
+    for i, (bug_offset, pattern_id, bug_pattern, fix_code) in enumerate(plan):
+        print(f"   [{i+1}] Offset: {bug_offset}, Length: {len(bug_pattern)} bytes ({pattern_id})")
+
+        if mm[bug_offset:bug_offset + len(bug_pattern)] != bug_pattern:
+            raise RuntimeError(f"File changed during patch at offset {bug_offset}")
+
+        mm[bug_offset:bug_offset + len(fix_code)] = fix_code
+        flush_range(mm, bug_offset, len(fix_code))
+        written.append((bug_offset, fix_code))
+
+    return written
+
+
+def verify_patches(file_path, written):
+    """Read back only the patched ranges and check they hold the fix code."""
+    with open(file_path, 'rb') as f:
+        for offset, fix_code in written:
+            f.seek(offset)
+            if f.read(len(fix_code)) != fix_code:
+                raise RuntimeError(f"Verify failed: fix code not found at offset {offset}")
+
+
+def resign(file_path):
+    """Re-sign binary on macOS (required after modification)."""
+    print("   Re-signing binary...")
+    result = subprocess.run(
+        ['codesign', '--force', '--sign', '-', file_path],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Code signing failed: {result.stderr}")
+    print("   Signed successfully.")
+
+
+@locked
+def patch(file_path, use_cache=True, backup=False, keep=BACKUP_KEEP, max_age_days=None):
     """Apply Vietnamese IME fix to Bun binary."""
     print(f"-> File: {file_path}")
 
@@ -238,66 +666,111 @@ def patch(file_path):
         print(f"Lỗi: File không tồn tại: {file_path}", file=sys.stderr)
         return 1
 
-    # Read binary
-    with open(file_path, 'rb') as f:
-        content = f.read()
+    if os.path.getsize(file_path) == 0:
+        print(f"Lỗi: File rỗng: {file_path}", file=sys.stderr)
+        return 1
 
-    # Already patched?
-    if PATCH_MARKER in content:
+    # Patched by an earlier run, e.g. the one this run waited for: one stat
+    if patch_status(file_path) == STATE_PATCHED:
         print("Đã patch trước đó.")
         return 0
 
-    # Backup
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    backup_path = f"{file_path}.backup-{timestamp}"
-    shutil.copy2(file_path, backup_path)
-    print(f"   Backup: {backup_path}")
-
-    try:
-        # Find all bug patterns
-        bug_locations = find_all_bug_patterns(content)
-        print(f"   Found {len(bug_locations)} bug location(s)")
+    # Known build? Its cached offsets are checked instead of scanning
+    with phase('cache'):
+        version = detect_version(file_path)
+        cache_key = file_fingerprint(file_path, version, CACHE_SALT)
+        plan = cached_plan(cache_key, file_path) if use_cache else None
+
+    # The binary is read once: the same blocks feed the sha256, the scan
+    # and the backup copy (reflinked up front when the filesystem can)
+    staged = start_backup(file_path) if backup else None
+    if plan is None:
+        # Patch markers and the bug patterns that can occur in this version
+        # (all of them if unknown) are looked for in the bundle only
+        with phase('scan', os.path.getsize(file_path)):
+            hits, sha256 = read_patch_state(file_path, rules_for('bun', version), staged)
+        if version is None:
+            version = next((v.decode('ascii') for _, pattern_id, v in hits if pattern_id == PATTERN_VERSION), None)
+
+        # Already patched?
+        if any(pattern_id == PATTERN_MARKER for _, pattern_id, _ in hits):
+            discard_backup(staged)
+            print("Đã patch trước đó.")
+            write_state(file_path, version, CACHE_SALT)
+            return 0
+    else:
+        # The checksum of this build was stored with its offsets; the file
+        # is only read whole when it was not, or a backup needs the bytes
+        sha256 = cached_sha256(cache_key)
+        if sha256 is None or (staged and staged[1] == 'copy'):
+            with phase('read', os.path.getsize(file_path)):
+                _, sha256 = tee_scan(file_path, staged=staged)
 
-        patched = content
-        for i, (bug_offset, bug_pattern) in enumerate(bug_locations):
-            print(f"   [{i+1}] Offset: {bug_offset}, Length: {len(bug_pattern)} bytes")
+    journal = None
+    committed = False
 
-            # Generate fix
-            fix_code = generate_fix(bug_pattern)
+    try:
+        if plan is not None:
+            print(f"   Cache: {len(plan)} bug location(s) đã biết, bỏ qua scan")
+        else:
+            # Find all bug patterns
+            bug_locations = [hit for hit in hits if hit[1] not in (PATTERN_MARKER, PATTERN_VERSION)]
+            if not bug_locations:
+                raise RuntimeError(BUG_NOT_FOUND)
+            # Version only known from the bundle: prefer the rules made for it
+            preferred = {rule['name'] for rule in rules_for('bun', version)}
+            bug_locations = [hit for hit in bug_locations if hit[1] in preferred] or bug_locations
+            print(f"   Found {len(bug_locations)} bug location(s)")
+            with phase('generate') as record:
+                plan = plan_patches(bug_locations)
+                record['bytes'] = sum(len(fix_code) for *_, fix_code in plan)
+
+        # Full backup into the content-addressed store, if asked for
+        with phase('backup'):
+            if backup:
+                blob, how = store_backup(file_path, sha256, keep, max_age_days, staged)
+                print(f"   Backup: {blob} ({how})")
+
+            # Journal the original bytes instead of backing up the whole binary
+            journal = write_journal(
+                file_path,
+                [(offset, original, fix_code) for offset, _, original, fix_code in plan],
+                sha256,
+            )
+            print(f"   Journal: {journal}")
 
-            if len(fix_code) != len(bug_pattern):
-                raise RuntimeError(f"Fix code length mismatch at offset {bug_offset}")
+        # Patch a private copy (a reflink where possible), sign and check it;
+        # only then does it replace the binary, in one rename
+        with atomic_update(file_path) as tmp:
+            # Only the pages holding a fix are touched
+            with phase('write', sum(len(fix_code) for *_, fix_code in plan)):
+                with open(tmp, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+                    written = apply_patches_in_place(mm, plan)
 
-            # Replace bug with fix (adjust offset for previous patches)
-            # Since all patterns have same length, offsets don't shift
-            patched = patched[:bug_offset] + fix_code + patched[bug_offset + len(bug_pattern):]
+            print(f"   Patched {len(written)} location(s)")
 
-        print(f"   Patched {len(bug_locations)} location(s)")
+            # Make executable (on Unix)
+            if platform.system() != 'Windows':
+                os.chmod(tmp, 0o755)
 
-        # Write patched binary
-        with open(file_path, 'wb') as f:
-            f.write(patched)
+            # Re-sign binary on macOS (required after modification)
+            if platform.system() == 'Darwin':
+                with phase('codesign'):
+                    resign(tmp)
 
-        # Make executable (on Unix)
-        if platform.system() != 'Windows':
-            os.chmod(file_path, 0o755)
+            # Verify
+            with phase('verify', sum(len(fix_code) for _, fix_code in written)):
+                verify_patches(tmp, written)
+        committed = True
 
-        # Re-sign binary on macOS (required after modification)
-        if platform.system() == 'Darwin':
-            print("   Re-signing binary...")
-            result = subprocess.run(
-                ['codesign', '--force', '--sign', '-', file_path],
-                capture_output=True, text=True
-            )
-            if result.returncode != 0:
-                raise RuntimeError(f"Code signing failed: {result.stderr}")
-            print("   Signed successfully.")
+        if use_cache:
+            cache_store(cache_key, [
+                [offset, pattern_id, original.hex(), fix_code.hex()]
+                for offset, pattern_id, original, fix_code in plan
+            ], sha256)
 
-        # Verify
-        with open(file_path, 'rb') as f:
-            verify_content = f.read()
-            if fix_code not in verify_content:
-                raise RuntimeError("Verify failed: fix code not found after write")
+        # Recorded last, once nothing else will touch the file
+        write_state(file_path, version, CACHE_SALT)
 
         print("\n   Patch thành công! Khởi động lại Claude Code.\n")
         return 0
@@ -305,22 +778,36 @@ def patch(file_path):
     except Exception as e:
         print(f"\nLỗi: {e}", file=sys.stderr)
         print("Báo lỗi tại: https://github.com/manhit96/claude-code-vietnamese-fix/issues", file=sys.stderr)
-        # Rollback
-        if os.path.exists(backup_path):
-            shutil.copy2(backup_path, file_path)
-            os.remove(backup_path)
-            print("Đã rollback về bản gốc.", file=sys.stderr)
+        discard_backup(staged)
+        # Nothing reached the binary before the rename, so there is nothing to roll back
+        if journal and not committed:
+            discard_journal(file_path)
+            print("File gốc không bị thay đổi.", file=sys.stderr)
         return 1
 
 
-def restore(file_path):
-    """Restore file from latest backup."""
+@locked
+def restore(file_path, verify=False):
+    """Restore file from its journal, or from the latest backup."""
+    journal = load_journal(file_path)
+    if journal is not None:
+        # codesign rewrote the signature, so only the journaled ranges match
+        is_macos = platform.system() == 'Darwin'
+        restore_journal(file_path, journal, verify=verify, check=not is_macos,
+                        finish=resign if is_macos else None)
+        clear_state(file_path)
+        print(f"Đã khôi phục từ journal: {journal_path(file_path)}")
+        print("Khởi động lại Claude Code.")
+        return 0
+
+    # Full-file backups made by older versions of the patcher
     backup = find_latest_backup(file_path)
     if not backup:
         print(f"Không tìm thấy backup cho {file_path}", file=sys.stderr)
         return 1
 
-    shutil.copy2(backup, file_path)
+    replace_from(backup, file_path)
+    clear_state(file_path)
 
     # Make executable (on Unix)
     if platform.system() != 'Windows':
@@ -331,14 +818,97 @@ def restore(file_path):
     return 0
 
 
+def export_patch(file_path, out_path, use_cache=True):
+    """Work out the patch of an unpatched binary and save it as an artifact."""
+    version = detect_version(file_path)
+    cache_key = file_fingerprint(file_path, version, CACHE_SALT)
+    plan = cached_plan(cache_key, file_path) if use_cache else None
+    if plan is None:
+        hits, sha256 = read_patch_state(file_path, rules_for('bun', version))
+        if any(pattern_id == PATTERN_MARKER for _, pattern_id, _ in hits):
+            print("Lỗi: File đã được patch, cần bản gốc để export", file=sys.stderr)
+            return 1
+        if version is None:
+            version = next((v.decode('ascii') for _, pattern_id, v in hits if pattern_id == PATTERN_VERSION), None)
+        bug_locations = [hit for hit in hits if hit[1] not in (PATTERN_MARKER, PATTERN_VERSION)]
+        if not bug_locations:
+            raise RuntimeError(BUG_NOT_FOUND)
+        plan = plan_patches(bug_locations)
+    else:
+        # Stored with the offsets; only builds cached before that are hashed
+        sha256 = cached_sha256(cache_key) or file_sha256(file_path)
+
+    write_artifact(
+        out_path, 'bun', file_path, sha256, version, CACHE_SALT,
+        [(offset, original, fix_code) for offset, _, original, fix_code in plan],
+    )
+    print(f"Đã export {len(plan)} location(s): {out_path}")
+    return 0
+
+
+@locked
+def apply_patch(file_path, artifact_path, verify=False):
+    """Apply an exported artifact: check the build, write, no scan."""
+    print(f"-> File: {file_path}")
+    artifact = load_artifact(artifact_path, 'bun')
+
+    if artifact_applied(file_path, artifact):
+        print("Đã patch trước đó.")
+        write_state(file_path, artifact['version'], artifact['fix'])
+        return 0
+
+    with phase('check', sum(len(original) for _, original, _ in artifact['entries'])):
+        sha256 = check_artifact(file_path, artifact, verify)
+
+    journal = write_journal(file_path, artifact['entries'], sha256)
+    try:
+        plan = [(offset, 'artifact', original, fix_code) for offset, original, fix_code in artifact['entries']]
+        with atomic_update(file_path) as tmp:
+            with phase('write', sum(len(fix_code) for *_, fix_code in plan)):
+                with open(tmp, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+                    written = apply_patches_in_place(mm, plan)
+            if platform.system() == 'Darwin':
+                resign(tmp)
+            with phase('verify', sum(len(fix_code) for _, fix_code in written)):
+                verify_patches(tmp, written)
+    except Exception:
+        discard_journal(file_path)
+        raise
+
+    write_state(file_path, artifact['version'], artifact['fix'])
+    print(f"   Journal: {journal}")
+    print("\n   Patch thành công! Khởi động lại Claude Code.\n")
+    return 0
+
+
 def show_help():
     """Hiển thị hướng dẫn sử dụng."""
     print("Claude Code Vietnamese IME Fix - Bun Binary Patcher")
     print("")
     print("Sử dụng:")
     print("  python3 patcher_bun.py              Tự động phát hiện và fix")
-    print("  python3 patcher_bun.py --restore    Khôi phục từ backup")
+    print("  python3 patcher_bun.py --restore    Khôi phục từ journal/backup")
+    print("  python3 patcher_bun.py --restore --verify")
+    print("                                      Kiểm tra thêm checksum toàn file")
     print("  python3 patcher_bun.py --path FILE  Fix file cụ thể")
+    print("  python3 patcher_bun.py --no-cache   Bỏ qua cache offset, luôn scan lại")
+    print("  python3 patcher_bun.py --timings    In bảng thời gian từng bước")
+    print("  python3 patcher_bun.py --json       Số liệu từng bước dạng JSON (stdout)")
+    print("  python3 patcher_bun.py --status     Trạng thái patch (exit 0/1/2), không scan file")
+    print("  python3 patcher_bun.py --all        Fix mọi Bun binary tìm thấy, song song")
+    print("    --jobs N                          Số tiến trình chạy song song (mặc định: số CPU)")
+    print("  python3 patcher_bun.py --watch      Chạy nền, tự patch lại sau khi Claude Code cập nhật")
+    print("    --poll / --interval S             Dùng polling thay inotify / chu kỳ polling (mặc định 2s)")
+    print("  python3 patcher_bun.py --no-wait    Bỏ qua nếu tiến trình khác đang patch (mặc định: chờ)")
+    print("  python3 patcher_bun.py --export FILE")
+    print("                                      Lưu patch thành artifact dùng cho máy khác")
+    print("  python3 patcher_bun.py --apply FILE")
+    print("                                      Áp dụng artifact cho bản build giống hệt, không scan")
+    print("    --verify                          Kiểm tra thêm sha256 toàn file trước khi ghi")
+    print("  python3 patcher_bun.py --backup     Lưu thêm bản sao đầy đủ (dedup, reflink)")
+    print("  python3 patcher_bun.py --prune-backups")
+    print("                                      Gom backup cũ vào store, áp dụng retention")
+    print("    --keep N / --max-age DAYS         Retention: giữ N bản / bỏ bản cũ hơn DAYS ngày")
     print("  python3 patcher_bun.py --help       Hiển thị hướng dẫn")
     print("")
     print("https://github.com/manhit96/claude-code-vietnamese-fix")
@@ -359,18 +929,71 @@ def main():
             idx = args.index('--path')
             file_path = args[idx + 1]
         else:
-            file_path = find_bun_binary()
-        return restore(file_path)
+            with phase('discover'):
+                file_path = find_bun_binary()
+        return run_measured(
+            restore, file_path, as_json='--json' in args, timings='--timings' in args,
+            verify='--verify' in args, wait='--no-wait' not in args,
+        )
 
     # Get path from --path or auto-detect
     file_path = None
     if '--path' in args:
         idx = args.index('--path')
         file_path = args[idx + 1]
-    else:
-        file_path = find_bun_binary()
+    elif '--all' not in args and '--watch' not in args:
+        with phase('discover'):
+            file_path = find_bun_binary()
+
+    # O(1) check against the state record, no scan
+    if '--status' in args:
+        return show_status(file_path)
+
+    # Portable patches: worked out once, applied to identical builds unscanned
+    if '--export' in args:
+        return export_patch(file_path, args[args.index('--export') + 1], use_cache='--no-cache' not in args)
+    if '--apply' in args:
+        return run_measured(
+            apply_patch, file_path, as_json='--json' in args, timings='--timings' in args,
+            artifact_path=args[args.index('--apply') + 1], verify='--verify' in args,
+            wait='--no-wait' not in args,
+        )
 
-    return patch(file_path)
+    # Backup retention
+    keep = int(args[args.index('--keep') + 1]) if '--keep' in args else BACKUP_KEEP
+    max_age_days = float(args[args.index('--max-age') + 1]) if '--max-age' in args else None
+
+    # Patch every Bun binary found, concurrently
+    if '--all' in args:
+        jobs = int(args[args.index('--jobs') + 1]) if '--jobs' in args else None
+        targets = [('bun', path) for path in find_all_bun_binaries()]
+        return run_fleet(
+            targets, jobs, use_cache='--no-cache' not in args,
+            backup='--backup' in args, keep=keep, max_age_days=max_age_days,
+            wait='--no-wait' not in args,
+        )
+
+    # Stay running and re-patch whenever an update replaces a target
+    if '--watch' in args:
+        def discover():
+            if file_path:
+                return [('bun', file_path)]
+            return [('bun', path) for path in find_all_bun_binaries()]
+
+        interval = float(args[args.index('--interval') + 1]) if '--interval' in args else 2.0
+        return watch(discover, interval, poll='--poll' in args)
+
+    if '--prune-backups' in args:
+        freed = prune_backups(file_path, keep, max_age_days)
+        print(f"Đã dọn backup, giải phóng {freed / 1e6:.1f} MB")
+        return 0
+
+    return run_measured(
+        patch, file_path, as_json='--json' in args, timings='--timings' in args,
+        use_cache='--no-cache' not in args,
+        backup='--backup' in args, keep=keep, max_age_days=max_age_days,
+        wait='--no-wait' not in args,
+    )
 
 
 if __name__ == '__main__':
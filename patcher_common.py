@@ -0,0 +1,1531 @@
+#!/usr/bin/env python3
+"""
+Claude Code Vietnamese IME Fix - Shared helpers
+
+Code used by both patcher.py (npm cli.js) and patcher_bun.py (Bun binary).
+
+Repository: https://github.com/manhit96/claude-code-vietnamese-fix
+License: MIT
+"""
+
+import io
+import os
+import errno
+import re
+import sys
+import json
+import shutil
+import stat
+import time
+import zlib
+import base64
+import hashlib
+import functools
+import platform
+import select
+import queue
+import threading
+import struct
+from pathlib import Path
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from importlib import import_module
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+CHUNK_SIZE = 1 << 20  # 1 MiB per read when streaming a file
+
+
+def window_feeder(scan, overlap, start=0):
+    """Push-style core of stream_scan(): returns (feed, hits).
+
+    feed(data, last) scans the next consecutive piece of a byte range that
+    begins at start, and appends hits to the hits list with their offsets
+    made absolute. last marks the final piece of the range.
+    """
+    hits = []
+    window = b''
+    base = start
+
+    def feed(data, last):
+        nonlocal window, base
+        buf = window + data if window else data
+        # Hits starting in the overlap tail are left for the next window
+        limit = len(buf) if last else len(buf) - overlap
+        for hit in scan(buf):
+            if hit[0] < limit:
+                hits.append((base + hit[0],) + tuple(hit[1:]))
+        window = buf[-overlap:] if overlap and not last else b''
+        base += len(buf) - len(window)
+
+    return feed, hits
+
+
+def stream_scan(file_path, scan, overlap, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """Run scan over file_path chunk by chunk and yield its hits.
+
+    scan(buf) yields tuples whose first item is an offset into buf. Matches
+    must be at most overlap bytes long: consecutive windows share overlap
+    bytes, so a match straddling a chunk boundary is still seen whole.
+    Each hit is yielded once, with its offset made absolute. Memory use
+    stays around chunk_size + overlap bytes whatever the file size.
+    Only bytes in [start, end) are read; end=None means end of file.
+    """
+    if chunk_size <= overlap:
+        raise ValueError("chunk_size must be larger than overlap")
+
+    with open(file_path, 'rb') as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        f.seek(start)
+
+        def read():
+            return f.read(max(0, min(chunk_size, end - f.tell())))
+
+        feed, hits = window_feeder(scan, overlap, start)
+        buf = read()
+        while buf:
+            chunk = read()
+            feed(buf, last=not chunk)
+            yield from hits
+            hits.clear()
+            buf = chunk
+
+
+def needle_scan(needles):
+    """A scan for stream_scan()/tee_scan() yielding (offset, needle) hits."""
+    def scan(buf):
+        for needle in needles:
+            idx = buf.find(needle)
+            while idx != -1:
+                yield idx, needle
+                idx = buf.find(needle, idx + len(needle))
+    return scan
+
+
+def stream_find(file_path, needle, chunk_size=CHUNK_SIZE):
+    """Yield the absolute offset of every occurrence of needle in file_path."""
+    for offset, _ in stream_scan(file_path, needle_scan([needle]), len(needle), chunk_size):
+        yield offset
+
+
+def read_range(file_path, start, end):
+    """Read bytes [start, end) of file_path."""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def splice_file(file_path, start, end, data, chunk_size=CHUNK_SIZE):
+    """Replace bytes [start, end) of file_path with data, in place.
+
+    When the length changes only the tail after end is moved, one chunk at
+    a time; when it does not, just the spliced bytes are written.
+    """
+    delta = len(data) - (end - start)
+    with open(file_path, 'r+b') as f:
+        size = os.fstat(f.fileno()).st_size
+        if delta > 0:
+            # Growing: move the tail right, starting from the last chunk
+            pos = size
+            while pos > end:
+                n = min(chunk_size, pos - end)
+                pos -= n
+                f.seek(pos)
+                buf = f.read(n)
+                f.seek(pos + delta)
+                f.write(buf)
+        elif delta < 0:
+            # Shrinking: move the tail left, starting from the first chunk
+            pos = end
+            while pos < size:
+                f.seek(pos)
+                buf = f.read(chunk_size)
+                f.seek(pos + delta)
+                f.write(buf)
+                pos += len(buf)
+            f.truncate(size + delta)
+
+        f.seek(start)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def rewrite_file(src, dst, edits, chunk_size=CHUNK_SIZE):
+    """Write src to dst with every (start, end, data) edit applied, in one pass.
+
+    edits are non-overlapping ranges of src, in file order. The bytes
+    between them are copied chunk by chunk and each replacement is written
+    once, so however many edits change the length, nothing moves twice.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        def copy(n):
+            while n is None or n > 0:
+                buf = s.read(chunk_size if n is None else min(chunk_size, n))
+                if not buf:
+                    return
+                d.write(buf)
+                if n is not None:
+                    n -= len(buf)
+
+        pos = 0
+        for start, end, data in edits:
+            copy(start - pos)
+            d.write(data)
+            s.seek(end)
+            pos = end
+        copy(None)
+        d.flush()
+        os.fsync(d.fileno())
+
+
+def shift_offsets(entries):
+    """Map (offset, original, replacement) entries onto the patched file.
+
+    Each offset moves by how much the replacements before it grew.
+    """
+    shifted, delta = [], 0
+    for offset, original, replacement in entries:
+        shifted.append((offset + delta, original, replacement))
+        delta += len(replacement) - len(original)
+    return shifted
+
+
+# ── Single-read pipeline ──────────────────────────────────────────────────────
+# patch() needs the bug offsets, the sha256 of the original and, with
+# --backup, a full copy. tee_scan() gets all three from one pass: every
+# block read goes to the hash, the scanner and a writer thread.
+TEE_CHUNK_SIZE = 4 * CHUNK_SIZE
+TEE_QUEUE = 4  # blocks waiting for the writer thread, bounds memory use
+
+
+def _copy_writer(blocks, copy_to, errors):
+    """Write blocks from the queue to copy_to until None arrives."""
+    out = None
+    try:
+        out = open(copy_to, 'wb')
+    except OSError as e:
+        errors.append(e)
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
+        if out is None:
+            continue  # keep draining so the reader never blocks
+        try:
+            out.write(block)
+        except OSError as e:
+            errors.append(e)
+            out.close()
+            out = None
+    if out is not None:
+        try:
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+        except OSError as e:
+            errors.append(e)
+
+
+def tee_scan(file_path, scan=None, overlap=0, ranges=None, staged=None, chunk_size=TEE_CHUNK_SIZE,
+             consume=None):
+    """Read file_path once, feeding each block to sha256, scan and a copy.
+
+    scan is as for stream_scan() and only sees the bytes inside ranges, a
+    list of (start, end) in file order (None: the whole file). staged is
+    a start_backup() result: unless it was reflinked, its copy is written
+    by a background thread while the next blocks are hashed and scanned.
+    consume, if given, is called with a read(n) that returns the next
+    bytes of the file, b'' at the end, and drives the read: a pull-style
+    reader such as a lexer sees the same blocks as everything else.
+    Returns (hits, sha256).
+    """
+    if scan is not None and chunk_size <= overlap:
+        raise ValueError("chunk_size must be larger than overlap")
+
+    digest = hashlib.sha256()
+    hits = []
+    writer = None
+    done = False
+    copy_to = staged[0] if staged and staged[1] == 'copy' else None
+    if copy_to is not None:
+        blocks, errors = queue.Queue(TEE_QUEUE), []
+        writer = threading.Thread(target=_copy_writer, args=(blocks, copy_to, errors), daemon=True)
+        writer.start()
+
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if scan is None:
+                ranges = []
+            elif not ranges:
+                ranges = [(0, size)]
+            feeders = [(start, min(end, size)) + window_feeder(scan, overlap, start)
+                       for start, end in ranges]
+
+            pos = 0
+
+            def read(n=chunk_size):
+                nonlocal pos
+                block = f.read(n)
+                if writer is not None and block:
+                    blocks.put(block)
+                digest.update(block)
+                block_end = pos + len(block)
+                for start, end, feed, found in feeders:
+                    lo, hi = max(start, pos), min(end, block_end)
+                    if lo < hi:
+                        feed(block[lo - pos:hi - pos], last=hi == end)
+                        hits.extend(found)
+                        found.clear()
+                pos = block_end
+                return block
+
+            if consume is not None:
+                consume(read)
+            # Whatever consume left unread still goes to the hash and copy
+            while read():
+                pass
+        done = True
+    finally:
+        if writer is not None:
+            blocks.put(None)
+            writer.join()
+        if not done:
+            discard_backup(staged)
+
+    if writer is not None:
+        if errors:
+            discard_backup(staged)
+            raise errors[0]
+        shutil.copystat(file_path, copy_to)
+    return hits, digest.hexdigest()
+
+
+# ── Patch rules ───────────────────────────────────────────────────────────────
+# Each patcher registers the bug patterns it can fix as rules, compiled once
+# at import: the Claude Code versions the pattern occurs in, a literal
+# anchor every match contains, a matcher confirming a candidate around the
+# anchor, and the fix generator. Knowing the version, a patcher scans only
+# for the rules that can be there.
+
+PATCH_RULES = {}  # kind ('npm' or 'bun') -> rules, preferred first
+VERSION_KEY_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+# Compiled alternations of anchors, for rule sets that do not share one
+_ANCHOR_RES = {}
+
+
+def version_key(version):
+    """(major, minor, patch) of a version string, or None."""
+    match = VERSION_KEY_RE.match(version or '')
+    return tuple(int(n) for n in match.groups()) if match else None
+
+
+def add_rule(kind, name, anchor, match, fix, lookbehind=0, length=0, since=None, until=None):
+    """Register a patch rule for kind and return it.
+
+    A match contains anchor, starts at most lookbehind bytes before it and
+    ends at most length bytes after it. match is a compiled regex or a
+    function (content, hit, lo, hi) -> (start, end) or None, given the
+    anchor offset and that window. fix(original) returns the fix code.
+    since is the first version with the pattern, until the first without.
+    """
+    if hasattr(match, 'search'):
+        pattern = match
+
+        def match(content, hit, lo, hi):
+            found = pattern.search(content, lo, hi)
+            return found.span() if found and found.start() <= hit else None
+
+    rule = {
+        'name': name, 'anchor': anchor, 'match': match, 'fix': fix,
+        'lookbehind': lookbehind, 'length': length,
+        'since': version_key(since), 'until': version_key(until),
+    }
+    PATCH_RULES.setdefault(kind, []).append(rule)
+    return rule
+
+
+def find_rule(kind, name):
+    """The rule of kind registered as name."""
+    return next(rule for rule in PATCH_RULES[kind] if rule['name'] == name)
+
+
+def rules_for(kind, version=None):
+    """Rules of kind that can match in version, preferred first.
+
+    All rules are returned when the version is unknown or no rule claims it.
+    """
+    rules = PATCH_RULES.get(kind, [])
+    key = version_key(version)
+    if key is None:
+        return list(rules)
+    matching = [
+        rule for rule in rules
+        if (rule['since'] is None or key >= rule['since'])
+        and (rule['until'] is None or key < rule['until'])
+    ]
+    return matching or list(rules)
+
+
+def rules_overlap(rules):
+    """Stream window overlap long enough for any match of rules."""
+    return max(rule['lookbehind'] + len(rule['anchor']) + rule['length'] for rule in rules)
+
+
+def scan_rules(content, rules, start=0, end=None):
+    """Yield (offset, rule, original_bytes) for each match in content[start:end].
+
+    One sweep finds the rules' anchors, with a plain find when they share
+    one. At each candidate the rules are tried in order and the first that
+    confirms it wins. Works on bytes and mmap objects alike.
+    """
+    end = len(content) if end is None else end
+    anchors = tuple(dict.fromkeys(rule['anchor'] for rule in rules))
+
+    if len(anchors) == 1:
+        anchor = anchors[0]
+
+        def next_anchor(pos):
+            hit = content.find(anchor, pos, end)
+            return (hit, anchor) if hit != -1 else None
+    else:
+        if anchors not in _ANCHOR_RES:
+            _ANCHOR_RES[anchors] = re.compile(b'|'.join(re.escape(a) for a in anchors))
+        anchor_re = _ANCHOR_RES[anchors]
+
+        def next_anchor(pos):
+            found = anchor_re.search(content, pos, end)
+            return (found.start(), found.group()) if found else None
+
+    pos = start
+    while True:
+        found = next_anchor(pos)
+        if found is None:
+            return
+        hit, anchor = found
+        pos = hit + len(anchor)
+
+        for rule in rules:
+            if rule['anchor'] != anchor:
+                continue
+            lo = max(start, hit - rule['lookbehind'])
+            hi = min(end, hit + len(anchor) + rule['length'])
+            bounds = rule['match'](content, hit, lo, hi)
+            if bounds:
+                yield bounds[0], rule, content[bounds[0]:bounds[1]]
+                pos = max(pos, bounds[1])
+                break
+
+
+# ── Phase metrics ─────────────────────────────────────────────────────────────
+
+# One record per timed phase of the current run, in order (see measured_run)
+PHASES = []
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == 'Darwin' else rss * 1024
+
+
+@contextmanager
+def phase(name, nbytes=None):
+    """Time one phase of a run and record it in PHASES.
+
+    Yields the record, so the caller can fill in 'bytes' once known. Timings
+    use the monotonic perf counter; 'peak_rss' is the process high-water mark
+    at the end of the phase.
+    """
+    record = {'phase': name, 'bytes': nbytes}
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - started
+        record['peak_rss'] = peak_rss()
+        PHASES.append(record)
+
+
+@contextmanager
+def measured_run():
+    """Scope PHASES to one run: it is emptied when the run ends.
+
+    Phases timed just before the run starts, such as discovery in main(),
+    count towards it. Long-lived processes (watch, fleet workers) patch
+    many targets; each run reports only its own phases and nothing piles
+    up between runs.
+    """
+    try:
+        yield PHASES
+    finally:
+        PHASES.clear()
+
+
+def metrics_report(target, rc):
+    """Machine-readable summary of the run."""
+    return {
+        'target': target,
+        'rc': rc,
+        'seconds': sum(r['seconds'] for r in PHASES),
+        'peak_rss': peak_rss(),
+        'phases': PHASES,
+    }
+
+
+def print_timings():
+    """Print PHASES as a table."""
+    def mb(value):
+        return '-' if value is None else f"{value / (1 << 20):.1f}"
+
+    print(f"   {'Phase':<10}{'Thời gian':>12}{'MB xử lý':>10}{'Peak RSS MB':>13}")
+    for r in PHASES:
+        print(f"   {r['phase']:<10}{r['seconds'] * 1000:>10.1f}ms{mb(r['bytes']):>10}{mb(r['peak_rss']):>13}")
+    print(f"   {'total':<10}{sum(r['seconds'] for r in PHASES) * 1000:>10.1f}ms")
+
+
+def run_measured(patch_fn, file_path, as_json=False, timings=False, **options):
+    """Run patch_fn(file_path, **options) and report its phases.
+
+    With as_json, progress lines go to stderr and stdout carries only the
+    JSON report; with timings, a table follows the usual output.
+    """
+    with measured_run():
+        if as_json:
+            with redirect_stdout(sys.stderr):
+                rc = patch_fn(file_path, **options)
+            print(json.dumps(metrics_report(file_path, rc), indent=2))
+            return rc
+
+        rc = patch_fn(file_path, **options)
+        if timings:
+            print_timings()
+        return rc
+
+
+# ── Offset cache ──────────────────────────────────────────────────────────────
+# Maps a cheap fingerprint of a target file to the patches found on it, so a
+# byte-identical build can be patched without scanning. Entries are checked
+# against the file before use and dropped when they no longer match.
+CACHE_FORMAT = 2
+MAX_CACHE_ENTRIES = 64
+FINGERPRINT_EDGE = 64 * 1024  # bytes hashed at each end of the file
+
+
+def cache_dir():
+    """Per-user cache directory (override with CLAUDE_VN_FIX_CACHE_DIR)."""
+    override = os.environ.get('CLAUDE_VN_FIX_CACHE_DIR')
+    if override:
+        return Path(override)
+    if platform.system() == 'Windows':
+        base = Path(os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local')
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+    return base / 'claude-vn-fix'
+
+
+def content_fingerprint(file_path):
+    """Cheap content identity of a file: size and head/tail hash.
+
+    Reads at most 2 * FINGERPRINT_EDGE bytes.
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_EDGE))
+        if size > FINGERPRINT_EDGE:
+            f.seek(max(FINGERPRINT_EDGE, size - FINGERPRINT_EDGE))
+            digest.update(f.read())
+    return f"{size}:{digest.hexdigest()[:32]}"
+
+
+def file_fingerprint(file_path, version=None, salt=''):
+    """Cheap identity of a file: size, mtime, head/tail hash and version.
+
+    salt separates entries made by different patchers or fix revisions.
+    """
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    return f"{salt}:{mtime_ns}:{content_fingerprint(file_path)}:{version or '-'}"
+
+
+def load_cache_file(name, fmt):
+    """Return the JSON object in cache_dir()/name, or None if missing,
+    unreadable or not of format fmt."""
+    try:
+        with open(cache_dir() / name, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('format') != fmt:
+        return None
+    return data
+
+
+def save_cache_file(name, data):
+    """Atomically write the JSON object data to cache_dir()/name.
+
+    Failures are ignored: cache files are only an optimisation.
+    """
+    path = cache_dir() / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def _load_cache():
+    cache = load_cache_file('offsets.json', CACHE_FORMAT)
+    return cache.get('entries', {}) if cache else {}
+
+
+def _save_cache(entries):
+    # Evict least recently used entries
+    if len(entries) > MAX_CACHE_ENTRIES:
+        keep = sorted(entries, key=lambda k: entries[k]['used'], reverse=True)
+        entries = {k: entries[k] for k in keep[:MAX_CACHE_ENTRIES]}
+
+    save_cache_file('offsets.json', {'format': CACHE_FORMAT, 'entries': entries})
+
+
+def cache_lookup(key):
+    """Return the patches cached for fingerprint key, or None."""
+    entries = _load_cache()
+    entry = entries.get(key)
+    if entry is None:
+        return None
+    entry['used'] = time.time()
+    _save_cache(entries)
+    return entry['patches']
+
+
+def cache_store(key, patches, sha256=None):
+    """Remember patches (a JSON-serialisable list) for fingerprint key.
+
+    sha256, the checksum of the unpatched file, spares a cache hit from
+    reading the whole file again just to journal it.
+    """
+    entries = _load_cache()
+    entries[key] = {'patches': patches, 'sha256': sha256, 'used': time.time()}
+    _save_cache(entries)
+
+
+def cached_sha256(key):
+    """sha256 stored with the entry for fingerprint key, or None."""
+    return _load_cache().get(key, {}).get('sha256')
+
+
+def cache_forget(key):
+    """Drop the entry for fingerprint key, e.g. after a failed check."""
+    entries = _load_cache()
+    if entries.pop(key, None) is not None:
+        _save_cache(entries)
+
+
+# ── Field stats ───────────────────────────────────────────────────────────────
+# An instrumented fix counts the IME events it handles and keeps a histogram
+# of handler time; each Claude Code process appends one JSON line to the
+# stats file when it exits. Bucket b counts calls under 2**b µs (the last
+# bucket is open-ended).
+STATS_FILE = 'ime-stats.jsonl'
+STATS_BUCKETS = 24
+
+
+def stats_path():
+    """File instrumented fixes append their records to."""
+    return cache_dir() / STATS_FILE
+
+
+def load_stats(path):
+    """Records in a stats file; lines cut short by a crash are skipped."""
+    records = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and len(record.get('hist') or ()) == STATS_BUCKETS:
+                    records.append(record)
+    except OSError:
+        pass
+    return records
+
+
+def stats_quantile(hist, q):
+    """Upper bound in µs of the bucket holding quantile q of hist, or None."""
+    total = sum(hist)
+    if not total:
+        return None
+    seen = 0
+    for b, count in enumerate(hist):
+        seen += count
+        if seen >= q * total:
+            return 2 ** b
+    return 2 ** (len(hist) - 1)
+
+
+def stats_summary(records):
+    """Totals, merged histogram and latency quantiles of stats records."""
+    hist = [sum(r['hist'][b] for r in records) for b in range(STATS_BUCKETS)]
+    return {
+        'sessions': len(records),
+        'events': sum(r.get('events', 0) for r in records),
+        'dels': sum(r.get('dels', 0) for r in records),
+        'seconds': sum(max(0, r.get('end', 0) - r.get('start', 0)) for r in records) / 1000,
+        'scripts': sorted({r['script'] for r in records if r.get('script')}),
+        'p50_us': stats_quantile(hist, 0.5),
+        'p90_us': stats_quantile(hist, 0.9),
+        'p99_us': stats_quantile(hist, 0.99),
+        'hist': hist,
+    }
+
+
+def report_stats(path=None, as_json=False):
+    """Summarise the stats file written by instrumented fixes."""
+    path = path or stats_path()
+    records = load_stats(path)
+    if not records:
+        print(f"Chưa có số liệu: {path}", file=sys.stderr)
+        print("Patch với --instrument rồi dùng Claude Code một lúc.", file=sys.stderr)
+        return 1
+
+    summary = stats_summary(records)
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    print(f"-> File: {path}")
+    print(f"   {summary['sessions']} phiên, {summary['seconds'] / 3600:.1f} giờ chạy, "
+          f"{summary['events']} sự kiện IME, {summary['dels']} backspace")
+    for script in summary['scripts']:
+        print(f"   {script}")
+    print(f"   Thời gian xử lý: p50 < {summary['p50_us']} µs, "
+          f"p90 < {summary['p90_us']} µs, p99 < {summary['p99_us']} µs")
+    print("")
+    hist = summary['hist']
+    peak = max(hist)
+    for b, count in enumerate(hist):
+        if count:
+            bound = f"< {2 ** b} µs" if b < STATS_BUCKETS - 1 else f">= {2 ** (b - 1)} µs"
+            print(f"   {bound:>14}  {'#' * max(1, round(40 * count / peak)):<40}  {count}")
+    return 0
+
+
+# ── Reverse-patch journal ─────────────────────────────────────────────────────
+# Instead of a full copy of the target, patch() records only the original
+# bytes at each patched offset (compressed), next to the target. Restoring
+# replays them in place.
+JOURNAL_FORMAT = 1
+JOURNAL_SUFFIX = '.vnfix-journal'
+
+
+def journal_path(file_path):
+    # Next to the real file, like the state record: npm's bin symlink and
+    # the path to cli.js find the same journal
+    return f"{os.path.realpath(file_path)}{JOURNAL_SUFFIX}"
+
+
+def file_sha256(file_path, chunk_size=CHUNK_SIZE):
+    """sha256 of the whole file, read chunk by chunk."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_journal(file_path, entries, sha256):
+    """Record how to undo a patch of file_path, before it is written.
+
+    entries is a list of (offset, original, replacement) where offset is the
+    position of replacement in the patched file. sha256 is the checksum of
+    the whole file before patching.
+    """
+    journal = {
+        'format': JOURNAL_FORMAT,
+        'sha256': sha256,
+        'fingerprint': content_fingerprint(file_path),
+        'mtime_ns': os.stat(file_path).st_mtime_ns,
+        'entries': [
+            [offset, base64.b64encode(zlib.compress(original, 9)).decode('ascii'),
+             len(replacement), hashlib.sha256(replacement).hexdigest()]
+            for offset, original, replacement in entries
+        ],
+    }
+    path = journal_path(file_path)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def load_journal(file_path):
+    """Return the journal recorded for file_path, or None."""
+    try:
+        with open(journal_path(file_path), 'r', encoding='utf-8') as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(journal, dict) or journal.get('format') != JOURNAL_FORMAT:
+        return None
+    return journal
+
+
+def replay_journal(file_path, journal):
+    """Put the original bytes back at every journaled offset, in place.
+
+    Entries are undone last first, so earlier offsets stay valid when a
+    replacement changed the file length. An entry whose range still holds
+    the original bytes (never applied) is skipped; any other content means
+    the file changed since it was patched.
+    """
+    for offset, original, length, replacement_sha256 in reversed(journal['entries']):
+        original = zlib.decompress(base64.b64decode(original))
+        current = read_range(file_path, offset, offset + length)
+        if hashlib.sha256(current).hexdigest() == replacement_sha256:
+            splice_file(file_path, offset, offset + length, original)
+        elif read_range(file_path, offset, offset + len(original)) != original:
+            raise RuntimeError(
+                f"File đã thay đổi sau khi patch (offset {offset}), không thể khôi phục từ journal"
+            )
+
+
+def restore_journal(file_path, journal, verify=False, check=True, finish=None):
+    """Undo the journaled patch of file_path and drop the journal.
+
+    The journal is replayed on a private copy (atomic_update()). The result
+    is checked against the recorded head/tail fingerprint, and against the
+    full sha256 when verify is set, before it replaces the target. check=False
+    skips both, for targets also changed outside the journaled ranges
+    (re-signed Mach-O). finish(copy), if given, runs last before the
+    rename. The pre-patch mtime is put back so the offset cache still matches.
+    """
+    with atomic_update(file_path) as tmp:
+        replay_journal(tmp, journal)
+        if finish is not None:
+            finish(tmp)
+
+        if check and content_fingerprint(tmp) != journal['fingerprint']:
+            raise RuntimeError("Nội dung sau khi khôi phục không khớp bản gốc")
+        if check and verify and file_sha256(tmp) != journal['sha256']:
+            raise RuntimeError("Checksum sau khi khôi phục không khớp bản gốc")
+
+        os.utime(tmp, ns=(os.stat(tmp).st_atime_ns, journal['mtime_ns']))
+    discard_journal(file_path)
+
+
+def discard_journal(file_path):
+    try:
+        os.remove(journal_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+# ── Patch artifacts ───────────────────────────────────────────────────────────
+# A patch worked out once, to apply to every identical build without scanning
+# or generating the fix again. The artifact is JSON: the target's kind, size
+# and sha256, the Claude Code version, the fix version (cache salt) and each
+# (offset, original, replacement), offsets into the unpatched file.
+
+ARTIFACT_FORMAT = 1
+
+
+def write_artifact(out_path, kind, file_path, sha256, version, fix, entries):
+    """Write the patch of file_path as an artifact at out_path."""
+    artifact = {
+        'format': ARTIFACT_FORMAT,
+        'kind': kind,
+        'size': os.path.getsize(file_path),
+        'sha256': sha256,
+        'version': version,
+        'fix': fix,
+        'entries': [
+            [offset, base64.b64encode(original).decode('ascii'),
+             base64.b64encode(replacement).decode('ascii')]
+            for offset, original, replacement in entries
+        ],
+    }
+    tmp = f"{out_path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, indent=1)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def load_artifact(path, kind):
+    """Read an artifact written for kind; entries come back as bytes."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f"Không đọc được artifact {path}: {e}")
+    if not isinstance(artifact, dict) or artifact.get('format') != ARTIFACT_FORMAT:
+        raise RuntimeError(f"Artifact không hợp lệ: {path}")
+    if artifact.get('kind') != kind:
+        raise RuntimeError(f"Artifact dành cho {artifact.get('kind')}, không phải {kind}")
+    artifact['entries'] = [
+        (offset, base64.b64decode(original), base64.b64decode(replacement))
+        for offset, original, replacement in artifact['entries']
+    ]
+    return artifact
+
+
+def artifact_applied(file_path, artifact):
+    """True if file_path already holds every replacement of artifact."""
+    delta = 0
+    for offset, original, replacement in artifact['entries']:
+        if read_range(file_path, offset + delta, offset + delta + len(replacement)) != replacement:
+            return False
+        delta += len(replacement) - len(original)
+    return True
+
+
+def check_artifact(file_path, artifact, verify=False):
+    """Raise RuntimeError unless file_path is the build artifact was made from.
+
+    The size and the original bytes at every offset are checked, which
+    reads only those ranges; verify also checks the full sha256. Returns
+    the sha256 for the journal: the recorded one unless it was computed.
+    """
+    if os.path.getsize(file_path) != artifact['size']:
+        raise RuntimeError("Kích thước file khác với bản tạo artifact")
+    for offset, original, _ in artifact['entries']:
+        if read_range(file_path, offset, offset + len(original)) != original:
+            raise RuntimeError(f"Nội dung tại offset {offset} khác với bản tạo artifact")
+    if not verify:
+        return artifact['sha256']
+    sha256 = file_sha256(file_path)
+    if sha256 != artifact['sha256']:
+        raise RuntimeError("Checksum khác với bản tạo artifact")
+    return sha256
+
+
+# ── Patch state record ────────────────────────────────────────────────────────
+# <target>.vnfix-state is one line of text written after a successful patch:
+#   vnfix-state <format> <size> <mtime_ns> <mtime_s> <inode> <version> <patch>
+# Comparing it with a single stat() tells whether the target is still the
+# file that was patched, without reading the target. mtime_s is there for the
+# shell launcher, whose stat only reports whole seconds.
+
+STATE_SUFFIX = '.vnfix-state'
+STATE_FORMAT = 1
+STATE_PATCHED, STATE_UNPATCHED, STATE_CHANGED = 'patched', 'unpatched', 'changed'
+
+
+def state_path(file_path):
+    # Next to the real file, so a symlinked launcher path finds it too
+    return f"{os.path.realpath(file_path)}{STATE_SUFFIX}"
+
+
+def write_state(file_path, version, patch_hash):
+    """Record that file_path, as it is now, carries the fix."""
+    st = os.stat(file_path)
+    line = (
+        f"vnfix-state {STATE_FORMAT} {st.st_size} {st.st_mtime_ns} {int(st.st_mtime)} "
+        f"{st.st_ino} {version or '-'} {patch_hash}\n"
+    )
+    path = state_path(file_path)
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(line)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def clear_state(file_path):
+    try:
+        os.remove(state_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def patch_status(file_path):
+    """STATE_PATCHED, STATE_UNPATCHED or STATE_CHANGED, from one stat().
+
+    'unpatched' means no record: the patcher never ran on this file (or a
+    version from before records existed did). 'changed' means the file was
+    modified or replaced since it was patched, e.g. by an auto-update.
+    """
+    try:
+        with open(state_path(file_path), 'r', encoding='utf-8') as f:
+            fields = f.read().split()
+    except OSError:
+        return STATE_UNPATCHED
+    if len(fields) != 8 or fields[:2] != ['vnfix-state', str(STATE_FORMAT)]:
+        return STATE_UNPATCHED
+
+    try:
+        st = os.stat(file_path)
+        size, mtime_ns, _, ino = (int(v) for v in fields[2:6])
+    except (OSError, ValueError):
+        return STATE_CHANGED
+    if (st.st_size, st.st_mtime_ns, st.st_ino) == (size, mtime_ns, ino):
+        return STATE_PATCHED
+    return STATE_CHANGED
+
+
+STATUS_TEXT = {
+    STATE_PATCHED: 'Đã patch',
+    STATE_UNPATCHED: 'Chưa patch',
+    STATE_CHANGED: 'Đã thay đổi sau khi patch, cần patch lại',
+}
+
+
+def show_status(file_path):
+    """Print the status of file_path; exit code 0 patched, 1 unpatched, 2 changed."""
+    status = patch_status(file_path)
+    print(f"{status}: {STATUS_TEXT[status]} ({file_path})")
+    return (STATE_PATCHED, STATE_UNPATCHED, STATE_CHANGED).index(status)
+
+
+# ── Atomic commits ────────────────────────────────────────────────────────────
+# A claude process starting while the target is being written must never run
+# a half-patched file, and two patcher runs (watcher, login hook, manual run)
+# must not interleave. Writers hold an advisory lock on a file in the cache
+# dir keyed by the target's real path, and patch a private copy, which
+# replaces the target in one rename.
+LOCK_DIR = 'locks'
+LOCK_POLL = 0.2  # seconds between lock attempts where the lock cannot block
+
+
+def _try_lock(fd, block):
+    """Lock fd exclusively; False if another process holds it and not block."""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not block:
+                    return False
+                time.sleep(LOCK_POLL)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+def lock_path(file_path):
+    """Lock file of file_path: keyed by its real path, so every path to one
+    target shares it, and kept out of the install directory."""
+    key = hashlib.sha256(os.path.realpath(file_path).encode('utf-8')).hexdigest()[:16]
+    return cache_dir() / LOCK_DIR / f"{key}.lock"
+
+
+@contextmanager
+def target_lock(file_path, wait=True):
+    """Hold the advisory lock of file_path for the duration of the block.
+
+    Yields True once held. When another run holds it, waits for it to
+    finish, or with wait=False yields False at once. Raises
+    FileNotFoundError if file_path does not exist, before creating anything.
+    """
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), file_path)
+    path = lock_path(file_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        held = _try_lock(fd, block=False)
+        if not held and wait:
+            print(f"   Đang chờ tiến trình patch khác trên {file_path}...", file=sys.stderr)
+            held = _try_lock(fd, block=True)
+        yield held
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def locked(fn):
+    """Run fn(file_path, ...) under target_lock(file_path).
+
+    The wrapped function takes an extra wait=True: with wait=False it
+    returns 0 straight away when another run holds the lock. A missing
+    file_path is left to fn to report, without locking.
+    """
+    @functools.wraps(fn)
+    def run(file_path, *args, wait=True, **kwargs):
+        if not os.path.isfile(file_path):
+            return fn(file_path, *args, **kwargs)
+        with target_lock(file_path, wait) as held:
+            if not held:
+                print(f"Một tiến trình khác đang patch {file_path}, bỏ qua.")
+                return 0
+            return fn(file_path, *args, **kwargs)
+    return run
+
+
+@contextmanager
+def atomic_update(file_path, copy=True):
+    """Yield a private copy of file_path to modify; it then replaces file_path.
+
+    The copy sits in the same directory (a reflink when the filesystem can)
+    and keeps the mode and owner; copy=False starts it empty instead, for
+    callers that write it whole. When the block exits cleanly it is
+    fsynced and renamed over the real file, so readers see either the old
+    or the new file, never a mix. On error it is removed and file_path is
+    left untouched.
+    """
+    target = os.path.realpath(file_path)
+    tmp = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.vnfix-tmp.{os.getpid()}")
+    st = os.stat(target)
+    if copy:
+        with phase('copy', st.st_size):
+            clone_file(target, tmp)
+    else:
+        open(tmp, 'wb').close()
+    try:
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        if hasattr(os, 'chown'):
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except OSError:
+                pass  # not ours to give away; the patching user keeps it
+        yield tmp
+        with phase('commit'):
+            with open(tmp, 'r+b') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    # Make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(target), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# ── Content-addressed backup store ────────────────────────────────────────────
+# Full copies of a target, kept next to it in BACKUP_DIR as one blob per
+# sha256, so identical originals are stored once. index.json lists the
+# backups of each target (newest last), which finds the latest in O(1).
+BACKUP_DIR = '.vnfix-backups'
+BACKUP_INDEX_FORMAT = 1
+BACKUP_KEEP = 3  # backups kept per target unless told otherwise
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+
+
+def reflink_file(src, dst):
+    """Make dst share src's blocks, if the filesystem can; True on success.
+
+    Uses FICLONE on Linux (btrfs, XFS, ...) and clonefile() on macOS (APFS).
+    """
+    system = platform.system()
+    if system == 'Linux':
+        try:
+            import fcntl
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return True
+        except OSError:
+            pass
+    elif system == 'Darwin':
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+                return True
+        except (OSError, AttributeError):
+            pass
+    return False
+
+
+def clone_file(src, dst):
+    """Copy src to dst, as a reflink when possible. Returns True for a reflink."""
+    if reflink_file(src, dst):
+        return True
+    shutil.copy2(src, dst)
+    return False
+
+
+def replace_from(src, dst):
+    """Atomically replace dst with a (reflinked if possible) copy of src."""
+    dst = os.path.realpath(dst)
+    tmp = f"{dst}.vnfix-tmp"
+    clone_file(src, tmp)
+    os.replace(tmp, dst)
+
+
+def backup_dir(file_path):
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), BACKUP_DIR)
+
+
+def _load_backup_index(store):
+    try:
+        with open(os.path.join(store, 'index.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get('format') != BACKUP_INDEX_FORMAT:
+        return {}
+    return index.get('targets', {})
+
+
+def _save_backup_index(store, targets):
+    path = os.path.join(store, 'index.json')
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'format': BACKUP_INDEX_FORMAT, 'targets': targets}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _apply_retention(store, targets, keep, max_age_days):
+    """Trim every target's backup list, then delete unreferenced blobs."""
+    now = time.time()
+    for name, entries in targets.items():
+        if max_age_days is not None:
+            cutoff = now - max_age_days * 86400
+            # The newest backup always stays, however old it is
+            entries[:-1] = [e for e in entries[:-1] if e['created'] >= cutoff]
+        if keep is not None:
+            del entries[:max(0, len(entries) - max(1, keep))]
+
+    referenced = {e['sha256'] for entries in targets.values() for e in entries}
+    for blob in os.listdir(store):
+        if len(blob) == 64 and blob not in referenced:
+            os.remove(os.path.join(store, blob))
+
+
+def start_backup(file_path):
+    """Stage a backup of file_path before its checksum is known.
+
+    The copy is a reflink when the filesystem can make one; otherwise it
+    is left for tee_scan() to write from the blocks it reads anyway.
+    Returns (tmp_path, how) for store_backup(staged=...).
+    """
+    store = backup_dir(file_path)
+    os.makedirs(store, exist_ok=True)
+    tmp = os.path.join(store, f"{os.path.basename(file_path)}.{os.getpid()}.tmp")
+    return tmp, 'reflink' if reflink_file(file_path, tmp) else 'copy'
+
+
+def discard_backup(staged):
+    """Remove a staged copy that store_backup() did not take."""
+    if staged and os.path.exists(staged[0]):
+        os.remove(staged[0])
+
+
+def store_backup(file_path, sha256, keep=BACKUP_KEEP, max_age_days=None, staged=None):
+    """Back up file_path (whose checksum is sha256) into the store.
+
+    staged is a start_backup() copy to use instead of copying again.
+    Returns (blob_path, how) where how is 'dedup' when the content was
+    already stored, 'reflink' or 'copy'. Retention is applied afterwards.
+    """
+    store = backup_dir(file_path)
+    os.makedirs(store, exist_ok=True)
+    blob = os.path.join(store, sha256)
+
+    if os.path.exists(blob):
+        how = 'dedup'
+        discard_backup(staged)
+    elif staged:
+        tmp, how = staged
+        os.replace(tmp, blob)
+    else:
+        tmp = f"{blob}.tmp"
+        how = 'reflink' if clone_file(file_path, tmp) else 'copy'
+        os.replace(tmp, blob)
+
+    targets = _load_backup_index(store)
+    name = os.path.basename(file_path)
+    entries = [e for e in targets.get(name, []) if e['sha256'] != sha256]
+    entries.append({'sha256': sha256, 'created': time.time()})
+    targets[name] = entries
+
+    _apply_retention(store, targets, keep, max_age_days)
+    _save_backup_index(store, targets)
+    return blob, how
+
+
+def latest_backup(file_path):
+    """Path of the newest stored backup of file_path, or None."""
+    store = backup_dir(file_path)
+    entries = _load_backup_index(store).get(os.path.basename(file_path))
+    if not entries:
+        return None
+    blob = os.path.join(store, entries[-1]['sha256'])
+    return blob if os.path.exists(blob) else None
+
+
+def prune_backups(file_path, keep=BACKUP_KEEP, max_age_days=None):
+    """Move legacy *.backup-<timestamp> copies into the store and trim it.
+
+    Identical legacy copies collapse into one blob. Returns the number of
+    bytes freed.
+    """
+    dir_path = os.path.dirname(os.path.abspath(file_path))
+    name = os.path.basename(file_path)
+    store = backup_dir(file_path)
+    os.makedirs(store, exist_ok=True)
+    targets = _load_backup_index(store)
+    entries = targets.setdefault(name, [])
+
+    def store_size():
+        return sum(os.path.getsize(os.path.join(store, b)) for b in os.listdir(store) if len(b) == 64)
+
+    legacy = [
+        os.path.join(dir_path, f) for f in os.listdir(dir_path)
+        if f.startswith(f"{name}.backup-")
+    ]
+    before = store_size() + sum(os.path.getsize(p) for p in legacy)
+
+    for path in sorted(legacy, key=os.path.getmtime):
+        sha256 = file_sha256(path)
+        blob = os.path.join(store, sha256)
+        created = os.path.getmtime(path)
+        if os.path.exists(blob):
+            os.remove(path)
+        else:
+            os.replace(path, blob)
+        entries[:] = [e for e in entries if e['sha256'] != sha256]
+        entries.append({'sha256': sha256, 'created': created})
+
+    entries.sort(key=lambda e: e['created'])
+    _apply_retention(store, targets, keep, max_age_days)
+    _save_backup_index(store, targets)
+    return before - store_size()
+
+
+# ── Fleet mode ────────────────────────────────────────────────────────────────
+
+FLEET_MODULES = {'npm': 'patcher', 'bun': 'patcher_bun'}
+
+
+def _fleet_worker(kind, file_path, options):
+    """Patch one target in a worker process, capturing what it prints."""
+    module = import_module(FLEET_MODULES[kind])
+    output = io.StringIO()
+    started = time.perf_counter()
+    with redirect_stdout(output), redirect_stderr(output), measured_run():
+        try:
+            rc = module.patch(file_path, **options)
+        except Exception as e:
+            print(f"Lỗi: {e}")
+            rc = 1
+    elapsed = time.perf_counter() - started
+
+    text = output.getvalue()
+    if rc != 0:
+        errors = [line for line in text.splitlines() if line.startswith('Lỗi')]
+        status = errors[-1] if errors else 'lỗi'
+    elif 'Đã patch trước đó' in text:
+        status = 'đã patch'
+    else:
+        status = 'patch mới'
+    return rc, status, module.detect_version(file_path) or '?', elapsed
+
+
+def run_fleet(targets, jobs=None, **options):
+    """Patch every (kind, path) in targets concurrently, one process each.
+
+    Prints a line per target as it finishes, then a summary table. Returns
+    0 only if every target ended up patched.
+    """
+    if not targets:
+        print("Không tìm thấy bản cài nào để patch.", file=sys.stderr)
+        return 1
+
+    total = len(targets)
+    results = {}
+    print(f"-> Patch {total} bản cài, {jobs or os.cpu_count()} tiến trình song song\n")
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(_fleet_worker, kind, path, options): (kind, path)
+            for kind, path in targets
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            kind, path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = (1, f"Lỗi: {e}", '?', 0.0)
+            results[(kind, path)] = result
+            rc, status, version, elapsed = result
+            mark = '✓' if rc == 0 else '✗'
+            print(f"   [{done}/{total}] {mark} {kind} {version} {path} ({elapsed:.2f}s)")
+
+    # Summary, in discovery order
+    rows = [('Loại', 'Version', 'Trạng thái', 'Thời gian', 'Đường dẫn')]
+    for kind, path in targets:
+        rc, status, version, elapsed = results[(kind, path)]
+        rows.append((kind, version, status, f"{elapsed:.2f}s", path))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    print("")
+    for row in rows:
+        print("   " + "  ".join(cell.ljust(w) for cell, w in zip(row, widths)) + "  " + row[4])
+
+    failed = sum(1 for rc, *_ in results.values() if rc != 0)
+    if failed:
+        print(f"\n   {failed}/{total} bản cài patch thất bại.", file=sys.stderr)
+        return 1
+    print(f"\n   Đã patch {total} bản cài. Khởi động lại Claude Code.\n")
+    return 0
+
+
+# ── Watch mode ────────────────────────────────────────────────────────────────
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then the name
+
+WATCH_DEBOUNCE = 0.5      # quiet time that ends a burst of writes, seconds
+WATCH_REDISCOVER = 300    # look for new installs at least this often, seconds
+
+
+def _inotify():
+    """(fd, add_watch) for a non-blocking inotify instance, or None."""
+    if platform.system() != 'Linux':
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    def add_watch(path):
+        return libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+    return fd, add_watch
+
+
+def _read_events(fd):
+    """Names from every pending inotify event."""
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return []
+    names, offset = [], 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        names.append(data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace'))
+        offset += length
+    return names
+
+
+def _watch_dirs(targets):
+    """Directories whose changes can replace a target.
+
+    The target's own directory and its parent (npm swaps whole package
+    directories), for both the path found and what it links to (the native
+    installer repoints ~/.local/bin/claude at a new version).
+    """
+    dirs = set()
+    for _, path in targets:
+        for p in (os.path.abspath(path), os.path.realpath(path)):
+            parent = os.path.dirname(p)
+            dirs.update((parent, os.path.dirname(parent)))
+    return sorted(d for d in dirs if os.path.isdir(d))
+
+
+def watch(discover, interval=2.0, poll=False):
+    """Re-patch targets as soon as an update replaces them. Runs until killed.
+
+    discover() returns the current [(kind, path)] targets. Uses inotify where
+    available and blocks until something changes, so it idles at zero CPU;
+    elsewhere the targets' state records are polled every `interval` seconds.
+    A target that fails to patch is not retried until it changes again.
+    """
+    failed = {}
+
+    def log(message):
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+    def signature(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def check(settle=False):
+        targets = discover()
+        for kind, path in targets:
+            try:
+                if patch_status(path) == STATE_PATCHED:
+                    continue
+                current = signature(path)
+                if failed.get(path) == current:
+                    continue
+                # Polling has no debounce of its own: skip a file still being written
+                if settle:
+                    time.sleep(WATCH_DEBOUNCE)
+                    if signature(path) != current:
+                        continue
+            except OSError:
+                continue
+            log(f"{kind}: {path} chưa được patch, đang patch...")
+            try:
+                with measured_run():
+                    rc = import_module(FLEET_MODULES[kind]).patch(path)
+            except Exception as e:  # e.g. no permission on the lock, file replaced mid-update
+                log(f"{kind}: {path} lỗi khi patch: {e}")
+                rc = 1
+            if rc == 0:
+                failed.pop(path, None)
+                continue
+            try:
+                # As left after the failed attempt (a rollback rewrites it)
+                failed[path] = signature(path)
+            except OSError:
+                # Gone: the next check sees whatever replaces it
+                failed.pop(path, None)
+        return targets
+
+    targets = check()
+    inotify = None if poll else _inotify()
+
+    if inotify is None:
+        log(f"Theo dõi {len(targets)} bản cài (polling mỗi {interval:g}s)...")
+        while True:
+            time.sleep(interval)
+            check(settle=True)
+
+    fd, add_watch = inotify
+    for d in _watch_dirs(targets):
+        add_watch(d)
+    log(f"Theo dõi {len(targets)} bản cài (inotify)...")
+
+    while True:
+        ready, _, _ = select.select([fd], [], [], WATCH_REDISCOVER)
+        # Debounce: an update writes in bursts, act once it has gone quiet
+        names = []
+        while ready:
+            names += _read_events(fd)
+            ready, _, _ = select.select([fd], [], [], WATCH_DEBOUNCE)
+        # Our own journal/state/temp files are no reason to look again
+        if names and all('.vnfix-' in name for name in names):
+            continue
+        targets = check()
+        for d in _watch_dirs(targets):
+            add_watch(d)
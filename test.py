@@ -2,20 +2,54 @@
 """
 Claude Code Vietnamese IME Fix - Test Runner
 
-Auto-downloads latest 3 npm versions, patches, verifies --version works.
+Tests npm versions in parallel: patches, verifies --version works, checks
+the fix logic, double-patch detection and restore. Every fix variant is
+also run in Node in strict mode, the way cli.js runs it.
+
+Versions come from a local content-addressed corpus (tests/corpus); only
+versions not cached yet are downloaded, and only their cli.js and
+package.json (plus the Bun binary when present) are extracted.
+
+Usage:
+  python3 test.py                      Latest 3 versions, cached ones reused
+  python3 test.py --offline            Cached versions only, no network
+  python3 test.py --latest N           Latest N versions
+  python3 test.py --versions SPEC      e.g. 2.0.0..2.0.30,1.0.9 (ranges inclusive)
+  python3 test.py --jobs N             Worker processes (default: CPU count)
+  python3 test.py --json FILE          Write results as JSON
+  python3 test.py --junit FILE         Write results as JUnit XML
 """
 
+import hashlib
+import io
 import json
+import os
 import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
+import time
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
 from pathlib import Path
 
+import patcher
+from patcher_common import clone_file, file_sha256, load_stats, STATS_FILE
+
 SCRIPT_DIR = Path(__file__).parent
-SOURCES_DIR = SCRIPT_DIR / "tests" / "sources"
-PATCHER = SCRIPT_DIR / "patcher.py"
+CORPUS_DIR = Path(os.environ.get("CLAUDE_VN_FIX_CORPUS", SCRIPT_DIR / "tests" / "corpus"))
+
+PACKAGE = "@anthropic-ai/claude-code"
+CORPUS_FORMAT = 1
+CHUNK_SIZE = 1 << 20
+
+# Files kept from each package: cli.js and the package.json next to it (the
+# patcher reads the version from it), and the Bun binary when one ships
+CORPUS_FILES = {"package/cli.js": "cli.js", "package/package.json": "package.json"}
+BUN_NAMES = ("claude", "claude.exe")
 
 GREEN = "\033[0;32m"
 RED = "\033[0;31m"
@@ -23,50 +57,185 @@ BLUE = "\033[0;34m"
 NC = "\033[0m"
 
 
-def get_latest_versions(count=3):
-    """Get latest N versions from npm registry."""
+def semver_key(v):
+    parts = v.replace("-", ".").split(".")
+    return tuple(int(p) if p.isdigit() else 0 for p in parts[:3])
+
+
+def get_versions():
+    """All published versions from the npm registry, newest first."""
     result = subprocess.run(
-        ["npm", "view", "@anthropic-ai/claude-code", "versions", "--json"],
+        ["npm", "view", PACKAGE, "versions", "--json"],
         capture_output=True, text=True, timeout=30
     )
     versions = json.loads(result.stdout)
+    return sorted(versions, key=semver_key, reverse=True)
+
+
+def select_versions(available, spec=None, latest=3):
+    """Pick versions from `available` (newest first).
+
+    spec is a comma-separated list of exact versions and inclusive ranges
+    ("2.0.0..2.0.30", "1.0.50..", "..0.2.9"). Without a spec, the newest
+    `latest` versions are used.
+    """
+    if not spec:
+        return available[:latest]
+    selected = set()
+    for item in spec.split(","):
+        if ".." in item:
+            low, high = item.split("..", 1)
+            selected.update(
+                v for v in available
+                if (not low or semver_key(v) >= semver_key(low))
+                and (not high or semver_key(v) <= semver_key(high))
+            )
+        elif item in available:
+            selected.add(item)
+    return sorted(selected, key=semver_key, reverse=True)
+
+
+# ── Version corpus ────────────────────────────────────────────────────────────
+# tests/corpus/objects/<sha256> holds each extracted file once; index.json maps
+# version -> {"cli.js": sha256, "bun": sha256}. Entries are reused across runs,
+# so only versions never seen before touch the network.
+
+def load_corpus_index():
+    try:
+        with open(CORPUS_DIR / "index.json", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("format") == CORPUS_FORMAT:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {"format": CORPUS_FORMAT, "versions": {}}
+
+
+def save_corpus_index(index):
+    tmp = CORPUS_DIR / "index.json.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp, CORPUS_DIR / "index.json")
+
+
+def cached_versions():
+    """Versions available offline, newest first."""
+    return sorted(load_corpus_index()["versions"], key=semver_key, reverse=True)
+
+
+def store_object(src):
+    """Copy a file object into the store while hashing it, return its sha256."""
+    objects = CORPUS_DIR / "objects"
+    objects.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=objects, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := src.read(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        os.replace(tmp, objects / sha256)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return sha256
+
+
+def tarball_url(version):
+    """Registry URL of a version's tarball (honours the npm registry setting)."""
+    try:
+        registry = subprocess.run(
+            ["npm", "config", "get", "registry"],
+            capture_output=True, text=True, timeout=30
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        registry = ""
+    registry = (registry or "https://registry.npmjs.org/").rstrip("/")
+    name = PACKAGE.split("/")[-1]
+    return f"{registry}/{PACKAGE}/-/{name}-{version}.tgz"
+
+
+def fetch_version(version, index):
+    """Stream a version's tarball and store only the files the tests use."""
+    entry = {}
+    with urllib.request.urlopen(tarball_url(version), timeout=120) as response:
+        # "r|gz": members are read in order straight off the socket
+        with tarfile.open(fileobj=response, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key = CORPUS_FILES.get(member.name)
+                if key is None and Path(member.name).name in BUN_NAMES:
+                    key = "bun"
+                if key:
+                    entry[key] = store_object(tar.extractfile(member))
+
+    for name in CORPUS_FILES.values():
+        if name not in entry:
+            raise RuntimeError(f"{name} not found in {PACKAGE}@{version}")
+    index["versions"][version] = entry
+    return entry
+
+
+def corpus_object(version, index, offline=False, key="cli.js"):
+    """Path of a version's file in the corpus, fetched first if missing.
+
+    A blob whose content no longer matches its sha256 is refetched, and so
+    is a version stored before key was kept.
+    """
+    entry = index["versions"].get(version)
+    if entry and key in entry:
+        blob = CORPUS_DIR / "objects" / entry[key]
+        try:
+            if file_sha256(blob) == entry[key]:
+                return blob
+        except OSError:
+            pass
+    if offline:
+        raise RuntimeError(f"v{version} not in corpus ({CORPUS_DIR})")
+    return CORPUS_DIR / "objects" / fetch_version(version, index)[key]
+
+
+def checkout(blob, work_dir, name="cli.js"):
+    """Writable copy of a corpus file for one test run (reflink if possible)."""
+    work_dir.mkdir(parents=True, exist_ok=True)
+    dst = work_dir / name
+    clone_file(str(blob), str(dst))
+    return dst
+
+
+def call_patcher(func, *args, **kwargs):
+    """Call a patcher function in-process, return (rc, stdout, stderr)."""
+    out, err = io.StringIO(), io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            rc = func(*args, **kwargs)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            rc = 1
+    return rc, out.getvalue(), err.getvalue()
 
-    def semver_key(v):
-        parts = v.replace("-", ".").split(".")
-        return tuple(int(p) if p.isdigit() else 0 for p in parts[:3])
-
-    return sorted(versions, key=semver_key, reverse=True)[:count]
-
-
-def download_npm(version):
-    """Download npm package and extract cli.js."""
-    version_dir = SOURCES_DIR / f"v{version}"
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        subprocess.run(
-            ["npm", "pack", f"@anthropic-ai/claude-code@{version}"],
-            cwd=temp_dir, capture_output=True, timeout=120
-        )
-        tarball = list(Path(temp_dir).glob("*.tgz"))[0]
 
-        version_dir.mkdir(parents=True, exist_ok=True)
-        with tarfile.open(tarball, "r:gz") as tar:
-            for member in tar.getmembers():
-                if member.name.startswith("package/"):
-                    member.name = member.name[8:]
-                    if member.name:
-                        tar.extract(member, version_dir, filter="data")
+def call_main(args, discovered):
+    """Run patcher.main() with args, auto-detection finding discovered.
 
-    return version_dir / "cli.js"
+    Returns (rc, stdout, stderr) like call_patcher().
+    """
+    argv, find = sys.argv, patcher.find_cli_js
+    sys.argv, patcher.find_cli_js = ["patcher.py", *args], lambda: str(discovered)
+    try:
+        return call_patcher(patcher.main)
+    finally:
+        sys.argv, patcher.find_cli_js = argv, find
 
 
-def run_patcher(args):
-    """Run patcher with args, return (success, stdout, stderr)."""
-    result = subprocess.run(
-        [sys.executable, str(PATCHER)] + args,
-        capture_output=True, text=True, timeout=30
-    )
-    return result.returncode == 0, result.stdout, result.stderr
+def json_phases(stdout):
+    """Phase names in a --json report, or None if stdout is not one."""
+    try:
+        return [record["phase"] for record in json.loads(stdout)["phases"]]
+    except (ValueError, KeyError, TypeError):
+        return None
 
 
 def verify_runs(file_path):
@@ -79,132 +248,322 @@ def verify_runs(file_path):
 
 
 def verify_fix_logic(file_path):
-    """Verify patched code contains correct fix logic (backspace + insert)."""
+    """Verify every patched location contains correct fix logic (backspace + insert)."""
     content = Path(file_path).read_text(encoding='utf-8')
+    marker = "/* Vietnamese IME fix */"
 
     # Must have patch marker
-    if "/* Vietnamese IME fix */" not in content:
+    if marker not in content:
         return False, "missing patch marker"
 
-    # Extract the fix block (from marker to next return;})
-    marker_idx = content.index("/* Vietnamese IME fix */")
-    fix_end = content.find("return;}", marker_idx)
-    if fix_end == -1:
-        return False, "cannot find fix block end"
-    fix_block = content[marker_idx:fix_end + 8]
-
-    # Must have backspace loop
-    if ".backspace()" not in fix_block:
-        return False, "missing .backspace() in fix"
-
-    # Must have insert loop
-    if ".insert(" not in fix_block:
-        return False, "missing .insert() in fix"
-
-    # Original bug pattern should be gone (deleteTokenBefore is in the old bug block)
-    # Note: deleteTokenBefore may still exist elsewhere in the file, so check
-    # that there's no block combining includes(\x7f) with deleteTokenBefore
+    # Check each fix block (from its marker to the next return;})
+    fixes = 0
+    marker_idx = content.find(marker)
+    while marker_idx != -1:
+        fixes += 1
+        fix_end = content.find("return;}", marker_idx)
+        if fix_end == -1:
+            return False, f"cannot find end of fix block {fixes}"
+        fix_block = content[marker_idx:fix_end + 8]
+
+        # Must have backspace loop
+        if ".backspace()" not in fix_block:
+            return False, f"missing .backspace() in fix block {fixes}"
+
+        # Must have insert loop
+        if ".insert(" not in fix_block:
+            return False, f"missing .insert() in fix block {fixes}"
+
+        marker_idx = content.find(marker, fix_end)
+
+    # Original bug pattern should be gone everywhere (deleteTokenBefore is in
+    # the old bug block). Note: deleteTokenBefore may still exist elsewhere
+    # in the file, so count the includes(\x7f) checks instead: at most one
+    # per fix block may be left
     del_char = chr(127)
     bug_pattern = f'.includes("{del_char}")'
-    # Count occurrences - should only appear in our fix block
     occurrences = content.count(bug_pattern)
-    if occurrences > 1:
-        return False, f"bug pattern appears {occurrences} times (expected 1 from fix)"
+    if occurrences > fixes:
+        return False, f"bug pattern appears {occurrences} times (expected {fixes} from fixes)"
+
+    return True, f"fix logic OK ({fixes} location(s))"
+
+
+# Runs a generated fix the way cli.js does: as an ES module (strict mode),
+# where only the input, the cursor and the two setters exist outside the
+# replaced block. Each event is handled by a stand-in of the input handler,
+# whose code after the block maps a few keys and inserts anything else,
+# working from the cursor as the fix leaves it.
+STRICT_HARNESS = r"""
+class Cursor {
+  constructor(text, offset) { this.text = text; this.offset = offset; }
+  backspace() {
+    return this.offset ? new Cursor(this.text.slice(0, this.offset - 1) + this.text.slice(this.offset), this.offset - 1) : this;
+  }
+  insert(s) {
+    return new Cursor(this.text.slice(0, this.offset) + s + this.text.slice(this.offset), this.offset + s.length);
+  }
+  left() { return new Cursor(this.text, Math.max(0, this.offset - 1)); }
+  equals(o) { return this.text === o.text && this.offset === o.offset; }
+}
+const KEYS = { "\x1b[D": c => c.left(), "\r": c => c.insert("\n") };
+const handle = (cur, input) => {
+  let text = cur.text, next = cur;
+  const setText = t => { text = t }, setOffset = o => { next = new Cursor(text, o) };
+  next = (() => { FIX; return KEYS[input] ? KEYS[input](cur) : cur.insert(input); })() ?? next;
+  return next;
+};
+let cur = new Cursor("", 0);
+for (const input of EVENTS) cur = handle(cur, input);
+process.stdout.write(JSON.stringify([cur.text, cur.offset]));
+"""
 
-    return True, "fix logic OK"
+# name: (events, [text, offset] after them)
+STRICT_CASES = {
+    # Typing "Việt" with Telex: each mark replaces the tail shown so far;
+    # the last burst arrives split, its DELs and its new text as two events
+    "telex": (["V", "i", "e", "\x7fê", "t", "\x7f\x7f", "ệt"], ["Việt", 4]),
+    # A DEL-only burst, then keys handled after the fix block: they must
+    # act on the text the burst left, not on the cursor from before it
+    "burst then arrow/Enter": (["V", "i", "e", "t", "\x7f\x7f", "\x1b[D", "\r"], ["V\ni", 2]),
+}
+
+# Fix variants patch() can emit: generate_fix() options
+FIX_VARIANTS = {
+    "default": {}, "coalesce": {"coalesce": 0}, "coalesce 5ms": {"coalesce": 5},
+    "instrument": {"instrument": True},
+}
+
+
+def verify_fix_strict(options):
+    """Run one fix variant in strict mode; returns (ok, detail)."""
+    fix = patcher.generate_fix({
+        "input": "input", "state": "Q", "cur_state": "cur",
+        "update_text": "setText", "update_offset": "setOffset",
+    }, **options)
+    for case, (events, expected) in STRICT_CASES.items():
+        source = STRICT_HARNESS.replace("FIX", fix).replace("EVENTS", json.dumps(events))
+        with tempfile.TemporaryDirectory(prefix="vnfix-stats-") as cache:
+            # An instrumented fix finds its stats file through this at run time
+            env = {**os.environ, "CLAUDE_VN_FIX_CACHE_DIR": cache}
+            result = subprocess.run(
+                ["node", "--input-type=module"], input=source,
+                capture_output=True, text=True, timeout=10, env=env
+            )
+            if result.returncode != 0:
+                errors = [line for line in result.stderr.splitlines() if "Error" in line]
+                return False, f"{case}: {errors[0].strip() if errors else 'node failed'}"
+            if json.loads(result.stdout) != expected:
+                return False, f"{case}: got {result.stdout}, expected {json.dumps(expected)}"
+            if options.get("instrument"):
+                # The fix only handles the events carrying DELs
+                handled = [sum("\x7f" in event for event in events)]
+                recorded = [record.get("events") for record in load_stats(Path(cache) / STATS_FILE)]
+                if recorded != handled:
+                    return False, f"{case}: stats recorded events {recorded}, expected {handled}"
+    return True, "ok"
+
+
+# ── Version matrix ────────────────────────────────────────────────────────────
+
+def test_version(version, blobs, work_root):
+    """Run every check for one version; returns a result record.
+
+    Runs in a worker process. patcher.patch()/restore() are called in-process,
+    only `node --version` starts a subprocess.
+    """
+    started = time.perf_counter()
+    result = {"version": version, "ok": False, "step": None, "detail": "", "output": ""}
+
+    def fail(step, detail):
+        result.update(step=step, detail=detail.strip(), time=time.perf_counter() - started)
+        return result
+
+    try:
+        for name, blob in blobs.items():
+            checkout(blob, work_root / f"v{version}", name)
+        cli_js = work_root / f"v{version}" / "cli.js"
+
+        # The version the patcher keys its caches and rules on
+        detected = patcher.detect_version(cli_js)
+        if detected != version:
+            return fail("version", f"detect_version() returned {detected!r}")
+
+        # Test patch
+        rc, _, stderr = call_patcher(patcher.patch, str(cli_js))
+        if rc != 0:
+            return fail("patch", f"Patch failed: {stderr}")
+
+        # Verify --version
+        ok, output = verify_runs(cli_js)
+        if not ok:
+            return fail("verify", "--version failed")
+        result["output"] = output
+
+        # Verify fix logic (backspace + insert)
+        ok, detail = verify_fix_logic(cli_js)
+        if not ok:
+            return fail("logic", detail)
+
+        # Test double-patch, through the CLI: the --json report must
+        # include the auto-detection
+        _, stdout, stderr = call_main(["--json"], cli_js)
+        if "Đã patch" not in stderr:
+            return fail("double", "double-patch not detected")
+        phases = json_phases(stdout)
+        if not phases or "discover" not in phases:
+            return fail("json", f"no discover phase in --json report: {phases}")
+
+        # Test restore, through the CLI with a --json report
+        rc, stdout, stderr = call_main(["--restore", "--json"], cli_js)
+        if rc != 0:
+            return fail("restore", f"restore failed: {stderr}")
+        if json_phases(stdout) is None:
+            return fail("json", f"restore --json printed no report: {stdout!r}")
+
+    except Exception as e:
+        return fail("error", str(e))
+    finally:
+        shutil.rmtree(work_root / f"v{version}", ignore_errors=True)
+
+    result.update(ok=True, time=time.perf_counter() - started)
+    return result
+
+
+def prepare_corpus(versions, index, offline, jobs):
+    """Make sure every version is in the corpus.
+
+    Returns {version: {name: blob} or error}, one blob per CORPUS_FILES name.
+    """
+    def one(version):
+        try:
+            return {name: corpus_object(version, index, offline, name) for name in CORPUS_FILES.values()}
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        blobs = dict(zip(versions, pool.map(one, versions)))
+    save_corpus_index(index)
+    return blobs
+
+
+def write_json_report(path, results):
+    Path(path).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+def write_junit_report(path, results):
+    """JUnit XML: one testcase per version, failures carry the failing step."""
+    suite = ET.Element(
+        "testsuite", name="claude-vn-fix", tests=str(len(results)),
+        failures=str(sum(1 for r in results if not r["ok"])),
+        time=f"{sum(r['time'] for r in results):.3f}",
+    )
+    for r in results:
+        edge = r["version"] == "N/A"
+        case = ET.SubElement(
+            suite, "testcase", classname="edge" if edge else "npm",
+            name=r.get("name", "nonexistent file") if edge else f"v{r['version']}", time=f"{r['time']:.3f}",
+        )
+        if not r["ok"]:
+            failure = ET.SubElement(case, "failure", message=r["step"])
+            failure.text = r["detail"]
+    ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
 
 
 def main():
+    args = sys.argv[1:]
     print()
     print("=" * 60)
     print("  Claude Code Vietnamese IME Fix - Test Suite")
     print("=" * 60)
     print()
 
-    # Clean old sources
-    if SOURCES_DIR.exists():
-        print(f"{BLUE}-> Cleaning old sources...{NC}")
-        shutil.rmtree(SOURCES_DIR)
-
-    # Get versions
-    print(f"{BLUE}-> Getting latest versions...{NC}")
-    versions = get_latest_versions(3)
-    print(f"   {', '.join(versions)}")
-    print()
-
-    results = []
-
-    for version in versions:
-        print(f"{BLUE}-> Testing v{version}{NC}")
-        print(f"   downloading...", end=" ", flush=True)
+    offline = "--offline" in args
+    jobs = int(option(args, "--jobs", os.cpu_count() or 1))
+    index = load_corpus_index()
 
+    # Get versions: the registry when reachable, else whatever is cached
+    print(f"{BLUE}-> Getting versions...{NC}")
+    available = None
+    if not offline:
         try:
-            cli_js = download_npm(version)
-
-            # Test patch
-            print("patch...", end=" ", flush=True)
-            ok, stdout, stderr = run_patcher(["--path", str(cli_js)])
-            if not ok:
-                print(f"{RED}✗{NC} Patch failed: {stderr}")
-                results.append(("patch", version, False))
-                continue
-
-            # Verify --version
-            print("verify...", end=" ", flush=True)
-            ok, output = verify_runs(cli_js)
-            if not ok:
-                print(f"{RED}✗{NC} --version failed")
-                results.append(("verify", version, False))
-                continue
-
-            # Verify fix logic (backspace + insert)
-            print("logic...", end=" ", flush=True)
-            ok, detail = verify_fix_logic(cli_js)
-            if not ok:
-                print(f"{RED}✗{NC} {detail}")
-                results.append(("logic", version, False))
-                continue
+            available = get_versions()
+        except (OSError, ValueError, subprocess.SubprocessError):
+            print("   registry unreachable, using cached versions")
+            offline = True
+    if offline:
+        available = cached_versions()
+    versions = select_versions(available, option(args, "--versions"), int(option(args, "--latest", 3)))
+    if not versions:
+        print(f"{RED}✗{NC} no versions available (corpus: {CORPUS_DIR})")
+        return 1
+    print(f"   {len(versions)}: {', '.join(versions)}")
+    print()
 
-            # Test double-patch
-            print("double-patch...", end=" ", flush=True)
-            ok, stdout, _ = run_patcher(["--path", str(cli_js)])
-            if "Đã patch" not in stdout:
-                print(f"{RED}✗{NC} double-patch not detected")
-                results.append(("double", version, False))
-                continue
+    missing = [v for v in versions if v not in index["versions"]]
+    if missing:
+        print(f"{BLUE}-> Downloading {len(missing)} versions into the corpus...{NC}")
+    blobs = prepare_corpus(versions, index, offline, jobs)
 
-            # Test restore
-            print("restore...", end=" ", flush=True)
-            ok, _, stderr = run_patcher(["--restore", "--path", str(cli_js)])
-            if not ok:
-                print(f"{RED}✗{NC} restore failed: {stderr}")
-                results.append(("restore", version, False))
+    print(f"{BLUE}-> Testing {len(versions)} versions, {jobs} workers{NC}")
+    results = []
+    work_root = Path(tempfile.mkdtemp(prefix="vnfix-test-"))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for version in versions:
+            files = blobs[version]
+            if isinstance(files, Exception):
+                results.append({"version": version, "ok": False, "step": "corpus",
+                                "detail": str(files), "output": "", "time": 0.0})
                 continue
-
-            print(f"{GREEN}✓{NC} {output}")
-            results.append(("npm", version, True))
-
-        except Exception as e:
-            print(f"{RED}✗{NC} {e}")
-            results.append(("npm", version, False))
-
-        print()
+            futures.append(pool.submit(test_version, version, files, work_root))
+        for future in as_completed(futures):
+            results.append(future.result())
+    shutil.rmtree(work_root, ignore_errors=True)
+
+    results.sort(key=lambda r: semver_key(r["version"]), reverse=True)
+    for r in results:
+        if r["ok"]:
+            print(f"   {GREEN}✓{NC} v{r['version']:<12} {r['time']:6.2f}s  {r['output']}")
+        else:
+            detail = " ".join(r["detail"].split())[:160]
+            print(f"   {RED}✗{NC} v{r['version']:<12} {r['time']:6.2f}s  {r['step']}: {detail}")
+    print()
 
     # Edge case: nonexistent file
     print(f"{BLUE}-> Testing edge cases{NC}")
     print(f"   nonexistent file...", end=" ", flush=True)
-    ok, _, _ = run_patcher(["--path", "/nonexistent/file.js"])
-    if not ok:
+    rc, _, _ = call_patcher(patcher.patch, "/nonexistent/file.js")
+    edge = {"version": "N/A", "ok": rc != 0, "step": None if rc else "edge",
+            "detail": "" if rc else "should have failed", "output": "", "time": 0.0}
+    if edge["ok"]:
         print(f"{GREEN}✓{NC} correctly rejected")
-        results.append(("edge", "N/A", True))
     else:
         print(f"{RED}✗{NC} should have failed")
-        results.append(("edge", "N/A", False))
+    results.append(edge)
+
+    for name, options in FIX_VARIANTS.items():
+        print(f"   {name} fix in strict mode...", end=" ", flush=True)
+        started = time.perf_counter()
+        ok, detail = verify_fix_strict(options)
+        results.append({"version": "N/A", "name": f"{name} fix in strict mode", "ok": ok,
+                        "step": None if ok else "strict", "detail": "" if ok else detail,
+                        "output": "", "time": time.perf_counter() - started})
+        print(f"{GREEN}✓{NC} {detail}" if ok else f"{RED}✗{NC} {detail}")
     print()
 
+    if "--json" in args:
+        write_json_report(option(args, "--json"), results)
+    if "--junit" in args:
+        write_junit_report(option(args, "--junit"), results)
+
     # Summary
     print("=" * 60)
-    passed = sum(1 for _, _, ok in results if ok)
+    passed = sum(1 for r in results if r["ok"])
     total = len(results)
 
     if passed == total:
@@ -216,4 +575,8 @@ def main():
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    # Offset cache, install index and stats of the runs under test stay out
+    # of the developer's own cache dir (workers inherit the variable)
+    with tempfile.TemporaryDirectory(prefix="vnfix-cache-") as cache:
+        os.environ["CLAUDE_VN_FIX_CACHE_DIR"] = cache
+        sys.exit(main())